@@ -8,15 +8,30 @@ Claude Chat Ultimate - 終極版
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog, font, colorchooser
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
 import json
 import os
 import re
 import base64
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from io import BytesIO
 import threading
+import asyncio
+import sqlite3
 import hashlib
+import time
+import random
+import heapq
+import math
+import mmap
+import zlib
+import struct
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # 嘗試導入PDF處理庫
 try:
@@ -36,113 +51,2450 @@ except ImportError:
 
 # 嘗試導入PIL用於圖片處理
 try:
-    from PIL import Image, ImageTk, ImageEnhance, ImageFilter
+    from PIL import Image, ImageTk, ImageFilter, ImageOps, features
     PIL_AVAILABLE = True
 except ImportError:
     PIL_AVAILABLE = False
     print("提示: 安裝Pillow可以獲得更好的圖片支持 (pip install Pillow)")
 
+# 嘗試導入NumPy用於本地語義檢索
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    print("提示: 安裝numpy可以使用知識庫語義檢索 (pip install numpy)")
+
+# 嘗試導入watchdog用於監視知識庫目錄
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    WATCHDOG_AVAILABLE = True
+except ImportError:
+    WATCHDOG_AVAILABLE = False
+    print("提示: 安裝watchdog可以即時監視知識庫變化,否則使用輪詢 (pip install watchdog)")
+
+
+class LazyDocument(dict):
+    """懶加載文檔: 只保存元數據,訪問'content'時才從磁盤讀取"""
+    
+    def __init__(self, loader, **metadata):
+        super().__init__(**metadata)
+        self.loader = loader
+    
+    def __missing__(self, key):
+        if key == 'content':
+            return self.loader(self['path'])
+        raise KeyError(key)
+
 
 class KnowledgeBase:
     """簡化的本地知識庫系統"""
     
-    def __init__(self, kb_dir="knowledge_base"):
+    # 倒排索引的n-gram長度(按字符切分,中英文通用)
+    NGRAM_SIZE = 3
+    INDEX_VERSION = 9
+    
+    # 段落切分: BM25按重疊段落建索引和返回結果
+    PASSAGE_CHARS = 600
+    PASSAGE_OVERLAP = 150
+    PASSAGE_BREAKS = '\n。！？!?.'
+    
+    # 分詞: 中日韓字符連續段落切成二元和三元組,其他文字按單詞切分
+    CJK_RUN_PATTERN = re.compile(
+        r'([\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)'
+        r'|([^\W\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)'
+    )
+    CJK_NGRAM_SIZES = (2, 3)
+    
+    # 搜索模式: keyword=整句子串匹配, bm25=多詞BM25排序,
+    # semantic=哈希n-gram向量相似度, hybrid=BM25與向量相似度加權融合(需要numpy)
+    SEARCH_MODES = ('keyword', 'bm25') + (('semantic', 'hybrid') if NUMPY_AVAILABLE else ())
+    BM25_K1 = 1.5
+    BM25_B = 0.75
+    
+    # 語義檢索: 哈希向量維度,以及hybrid模式中BM25分數所佔權重
+    VECTOR_DIM = 1024
+    HYBRID_BM25_WEIGHT = 0.5
+    # 矩陣文件中失效行超過此數且多於有效行時,壓縮成新文件
+    VECTOR_COMPACT_MIN = 1024
+    
+    # 懶加載模式下最近讀取文檔的緩存上限(字符數)
+    CONTENT_CACHE_CHARS = 4_000_000
+    
+    # 查詢結果緩存的條目上限
+    QUERY_CACHE_SIZE = 128
+    
+    # 後台攝取: 線程數和每批合併進索引的文件數
+    INGEST_WORKERS = 4
+    INGEST_BATCH = 64
+    
+    def __init__(self, kb_dir="knowledge_base", lazy=False, on_documents_changed=None):
         self.kb_dir = Path(kb_dir)
         self.kb_dir.mkdir(exist_ok=True)
+        self.lazy = lazy
+        self._content_cache = OrderedDict()  # 路徑 -> 內容
+        self._content_cache_chars = 0
+        # 倒排索引存放在知識庫目錄旁邊的SQLite文件中,查詢時只讀取查詢詞的posting,
+        # 不整體加載進內存;每批變化在一個事務中寫入
+        self.index_file = self.kb_dir.parent / f"{self.kb_dir.name}_index.db"
+        self.vectors_file = None  # 段落向量矩陣(float32原始數據,新段落追加在末尾,內存映射讀取)
+        self._conn = None  # 寫入連接,只在持有寫入鎖時使用
+        self._readers = threading.local()  # 搜索線程各自的只讀連接(WAL模式下不被寫入阻塞)
+        self._matrix = None
+        # 段落已刪除或重新索引後失效的行,第一次語義檢索或寫入時才從索引讀取(None表示尚未讀取)
+        self._stale_rows = None
+        self.generation = 0  # 索引每次變化都遞增,用於讓查詢緩存失效
+        self._query_cache = OrderedDict()  # (查詢, 模式, 結果數, generation) -> 結果
+        self._missing_paths = set()  # 搜索時發現已無法讀取的文件,搜索結束後交給update_files
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.documents = {}
+        self._doc_ids = {}  # 文檔名 -> 索引文件中的文檔編號
+        self._doc_names = {}  # 文檔編號 -> 文檔名
+        self.doc_passages = {}  # 文檔名 -> 段落數
+        self._doc_lengths = {}  # 文檔名 -> 各段落詞數之和
+        self.passage_count = 0
+        self.total_length = 0
+        self.search_mode = 'keyword'
+        self._doc_order = {}  # 文檔名 -> 加入順序,保證排序結果與全表掃描一致
+        self.manifest = {}  # 路徑 -> [字節數, 修改時間ns, sha256]
+        self._lock = threading.RLock()
+        # 寫入鎖讓各批變化依次寫入;寫文件和執行SQL時不佔用索引鎖,
+        # 只在提交事務並替換內存元數據時短暫持有,搜索不會被寫入阻塞
+        self._write_lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=self.INGEST_WORKERS)
+        self.on_documents_changed = on_documents_changed  # 後台攝取完成後的回調(在工作線程中調用)
+        self.ingest_thread = None
+        # 啟動時只讀取元數據,新增或修改的文件在後台攝取
+        self.load_index()
         self.load_documents()
     
     def load_documents(self):
-        """加載所有文檔到內存"""
+        """掃描知識庫目錄: 未變化的文件直接複用索引,新增或修改的文件在後台攝取"""
+        current = {}
         for file_path in self.kb_dir.glob("**/*.*"):
-            if file_path.suffix.lower() in ['.txt', '.md', '.json']:
+            if self._is_supported(file_path):
                 try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        self.documents[file_path.name] = {
-                            'content': content,
-                            'path': str(file_path),
-                            'size': len(content)
-                        }
-                except Exception as e:
+                    current[str(file_path)] = (file_path, file_path.stat())
+                except OSError as e:
                     print(f"無法加載 {file_path}: {e}")
+        
+        with self._lock:
+            removed = [path for path in self.manifest if path not in current]
+        self._sync_files(current, removed)
     
-    def add_document(self, filename, content):
-        """添加文檔到知識庫"""
-        file_path = self.kb_dir / filename
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            self.documents[filename] = {
+    def update_files(self, paths):
+        """只檢查指定的路徑(來自文件監視器的事件),增量更新索引"""
+        current = {}
+        removed = []
+        for file_path in self._expand_paths(paths):
+            if not self._is_supported(file_path):
+                continue
+            try:
+                current[str(file_path)] = (file_path, file_path.stat())
+            except FileNotFoundError:
+                if str(file_path) in self.manifest:
+                    removed.append(str(file_path))
+            except OSError as e:
+                print(f"無法加載 {file_path}: {e}")
+        self._sync_files(current, removed)
+    
+    def _expand_paths(self, paths):
+        """把路徑展開成要檢查的文件: 目錄換成其中的文件,已不存在的路徑
+        (可能是被刪除或移走的目錄)再加上文件清單中位於它下面的條目"""
+        files = set()
+        prefixes = []
+        for path in paths:
+            file_path = self._normalize_path(path)
+            if file_path.is_dir():
+                files.update(file_path.glob("**/*.*"))
+                continue
+            files.add(file_path)
+            if not file_path.exists():
+                prefixes.append(str(file_path) + os.sep)
+        
+        if prefixes:
+            prefixes = tuple(prefixes)
+            with self._lock:
+                files.update(Path(path) for path in self.manifest if path.startswith(prefixes))
+        return files
+    
+    def _normalize_path(self, path):
+        """把監視器給出的路徑轉換成與文件清單一致的形式(相對於知識庫目錄)"""
+        file_path = Path(path)
+        if file_path.is_absolute() != self.kb_dir.is_absolute():
+            try:
+                return self.kb_dir / file_path.resolve().relative_to(self.kb_dir.resolve())
+            except ValueError:
+                pass
+        return file_path
+    
+    def _is_supported(self, file_path):
+        """是否為知識庫支持的文本文件"""
+        return file_path.suffix.lower() in ['.txt', '.md', '.json']
+    
+    def _sync_files(self, current, removed):
+        """對比文件清單: 移除已刪除的文件,未變化的直接登記,其餘交給後台攝取"""
+        if (self.ingest_thread and self.ingest_thread.is_alive()
+                and self.ingest_thread is not threading.current_thread()):
+            self.ingest_thread.join()
+        
+        changed = []
+        with self._lock:
+            for path, (file_path, stat) in current.items():
+                entry = self.manifest.get(path)
+                if (entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns
+                        and file_path.name in self.doc_passages):
+                    try:
+                        self._register_document(file_path, stat)
+                    except Exception as e:
+                        print(f"無法加載 {file_path}: {e}")
+                else:
+                    changed.append((file_path, stat))
+            
+        
+        if removed:
+            try:
+                self._apply_changes(removed={Path(path).name for path in removed},
+                                    manifest=[(path, None) for path in removed])
+            except Exception as e:
+                print(f"更新知識庫索引失敗: {e}")
+            with self._lock:
+                for path in removed:
+                    self._content_cache.pop(path, None)
+        
+        if changed:
+            # 先啟動再賦值,等待方不會拿到尚未啟動的線程
+            thread = threading.Thread(target=self._ingest_files, args=(changed,), daemon=True)
+            thread.start()
+            self.ingest_thread = thread
+        elif removed and self.on_documents_changed:
+            self.on_documents_changed()
+    
+    def wait_until_ready(self, timeout=None):
+        """等待後台攝取完成"""
+        if self.ingest_thread:
+            self.ingest_thread.join(timeout)
+    
+    def _register_document(self, file_path, stat, content=None):
+        """登記文檔(懶加載模式下只記錄元數據)"""
+        if self.lazy:
+            doc = LazyDocument(
+                self._read_content,
+                path=str(file_path),
+                size=stat.st_size,
+                mtime=stat.st_mtime
+            )
+            if content is not None:
+                self._cache_content(str(file_path), content)
+        else:
+            if content is None:
+                content = self._read_file(file_path)
+            doc = {
                 'content': content,
                 'path': str(file_path),
                 'size': len(content)
             }
+        self.documents[file_path.name] = doc
+        self._doc_order.setdefault(file_path.name, len(self._doc_order))
+    
+    def _load_file(self, item):
+        """讀取、校驗並分析單個文件(在線程池中執行,不修改索引)"""
+        file_path, stat = item
+        try:
+            data = file_path.read_bytes()
+            content = data.decode('utf-8')
+        except Exception as e:
+            print(f"無法加載 {file_path}: {e}")
+            return None
+        
+        digest = hashlib.sha256(data).hexdigest()
+        entry = self.manifest.get(str(file_path))
+        if entry and entry[2] == digest and file_path.name in self.doc_passages:
+            # 只有修改時間變了,內容相同,不需要重新索引
+            return file_path, stat, digest, content, None
+        return file_path, stat, digest, content, self._analyze(content)
+    
+    def _ingest_files(self, items):
+        """後台攝取文件: 線程池並行讀取和分析,再分批合併進索引"""
+        for i in range(0, len(items), self.INGEST_BATCH):
+            batch = self._executor.map(self._load_file, items[i:i + self.INGEST_BATCH])
+            results = [result for result in batch if result]
+            # 同名文件以最後一個為準
+            indexed = {file_path.name: analysis for file_path, _, _, _, analysis in results
+                       if analysis is not None}
+            try:
+                self._apply_changes(
+                    indexed=list(indexed.items()),
+                    manifest=[(str(file_path), [stat.st_size, stat.st_mtime_ns, digest])
+                              for file_path, stat, digest, _, _ in results],
+                    documents=[(file_path, stat, content) for file_path, stat, _, content, _ in results])
+            except Exception as e:
+                print(f"更新知識庫索引失敗: {e}")
+        
+        if self.on_documents_changed:
+            self.on_documents_changed()
+    
+    def _read_file(self, path):
+        """通過內存映射讀取UTF-8文本,避免額外的緩衝區拷貝"""
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return ""
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return str(mapped, 'utf-8')
+    
+    def _read_content(self, path):
+        """按需讀取文檔內容,最近使用的內容保存在有上限的緩存中"""
+        content = self._content_cache.get(path)
+        if content is not None:
+            self._content_cache.move_to_end(path)
+            return content
+        
+        content = self._read_file(path)
+        self._cache_content(path, content)
+        return content
+    
+    def _cache_content(self, path, content):
+        """放入內容緩存,超出上限時淘汰最久未使用的文檔"""
+        old = self._content_cache.pop(path, None)
+        if old is not None:
+            self._content_cache_chars -= len(old)
+        if len(content) > self.CONTENT_CACHE_CHARS:
+            return
+        self._content_cache[path] = content
+        self._content_cache_chars += len(content)
+        while self._content_cache_chars > self.CONTENT_CACHE_CHARS:
+            _, evicted = self._content_cache.popitem(last=False)
+            self._content_cache_chars -= len(evicted)
+    
+    def add_document(self, filename, content):
+        """添加文檔到知識庫"""
+        file_path = self.kb_dir / filename
+        try:
+            data = content.encode('utf-8')
+            analysis = self._analyze(content)
+            with self._write_lock:
+                with open(file_path, 'wb') as f:
+                    f.write(data)
+                stat = file_path.stat()
+                # 只寫入這個文檔的變化
+                self._apply_changes(
+                    indexed=[(filename, analysis)],
+                    manifest=[(str(file_path), [stat.st_size, stat.st_mtime_ns,
+                                                hashlib.sha256(data).hexdigest()])],
+                    documents=[(file_path, stat, content)])
             return True
         except Exception as e:
             print(f"保存文檔失敗: {e}")
             return False
     
-    def search(self, query, max_results=3):
-        """簡單的關鍵詞搜索"""
-        results = []
-        query_lower = query.lower()
-        
-        for filename, doc in self.documents.items():
-            content_lower = doc['content'].lower()
-            if query_lower in content_lower:
-                # 計算相關度(簡單的出現次數)
-                relevance = content_lower.count(query_lower)
-                # 提取相關片段
-                snippets = self._extract_snippets(doc['content'], query, num_snippets=2)
-                results.append({
-                    'filename': filename,
-                    'relevance': relevance,
-                    'snippets': snippets,
-                    'path': doc['path']
-                })
+    def _ngrams(self, text_lower):
+        """切分出文本中所有不重複的n-gram"""
+        n = self.NGRAM_SIZE
+        return {text_lower[i:i + n] for i in range(len(text_lower) - n + 1)}
+    
+    def _tokenize(self, text):
+        """切分出用於BM25排序的詞(中日韓文字輸出n-gram,拉丁文字輸出單詞)"""
+        tokens = []
+        for match in self.CJK_RUN_PATTERN.finditer(text.lower()):
+            cjk_run, word = match.groups()
+            if word:
+                tokens.append(word)
+            else:
+                tokens.extend(self._cjk_ngrams(cjk_run))
+        return tokens
+    
+    def _cjk_ngrams(self, run):
+        """將沒有空格的中日韓文字段落切成二元和三元組"""
+        if len(run) < min(self.CJK_NGRAM_SIZES):
+            return [run]
+        return [run[i:i + n]
+                for n in self.CJK_NGRAM_SIZES
+                for i in range(len(run) - n + 1)]
+    
+    def _split_passages(self, content):
+        """將文檔切成重疊段落,返回 [(起始偏移, 結束偏移)]"""
+        spans = []
+        start = 0
+        length = len(content)
+        while start < length:
+            end = min(length, start + self.PASSAGE_CHARS)
+            if end < length:
+                # 盡量在換行或句末處斷開
+                min_end = start + self.PASSAGE_CHARS * 2 // 3
+                for pos in range(end - 1, min_end, -1):
+                    if content[pos] in self.PASSAGE_BREAKS:
+                        end = pos + 1
+                        break
+            spans.append((start, end))
+            if end >= length:
+                break
+            start = end - self.PASSAGE_OVERLAP
+        return spans
+    
+    def _analyze(self, content):
+        """計算文檔的n-gram、各段落詞頻和向量(不修改索引,可在線程池中執行)"""
+        grams = self._ngrams(content.lower())
+        passages = []
+        for start, end in self._split_passages(content):
+            terms = Counter(self._tokenize(content[start:end]))
+            vector = self._embed_terms(terms) if NUMPY_AVAILABLE else None
+            passages.append((start, end, terms, vector))
+        return grams, passages
+    
+    def _embed_terms(self, terms):
+        """把詞頻哈希成固定維度的向量(L2歸一化),不依賴模型或網絡"""
+        features = Counter(terms)
+        for term, count in terms.items():
+            # 長於3個字符的只可能是拉丁單詞,補充字符三元組以匹配詞形變化
+            if len(term) > 3:
+                padded = f"<{term}>"
+                for i in range(len(padded) - 2):
+                    features[padded[i:i + 3]] += count
+        
+        vector = np.zeros(self.VECTOR_DIM, dtype=np.float32)
+        for feature, count in features.items():
+            h = zlib.crc32(feature.encode('utf-8'))
+            sign = 1.0 if h & 0x80000000 else -1.0
+            vector[h % self.VECTOR_DIM] += sign * (1.0 + math.log(count))
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+    
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.index_file), check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            # 檢查點在提交之後、釋放索引鎖以後再做,不拖慢持鎖的提交
+            conn.execute("PRAGMA wal_autocheckpoint = 0")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifest ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                "sha256 TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, "
+                "passages INTEGER NOT NULL, length INTEGER NOT NULL)")
+            # 文檔索引時的n-gram和各段落的詞(zlib壓縮的JSON),刪除文檔時只按這些鍵刪除posting
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS doc_keys ("
+                "doc INTEGER PRIMARY KEY, grams BLOB NOT NULL, terms BLOB NOT NULL)")
+            # 每個段落一行: 偏移、長度和在向量矩陣中的行號(按行號索引,語義檢索時反查段落)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS passages ("
+                "doc INTEGER NOT NULL, number INTEGER NOT NULL, start_offset INTEGER NOT NULL, "
+                "end_offset INTEGER NOT NULL, length INTEGER NOT NULL, row INTEGER, "
+                "PRIMARY KEY (doc, number)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS passages_row ON passages (row)")
+            # 倒排索引: n-gram -> 文檔(關鍵詞模式篩選候選), 詞 -> 段落及詞頻(BM25)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS grams ("
+                "gram TEXT NOT NULL, doc INTEGER NOT NULL, PRIMARY KEY (gram, doc)) WITHOUT ROWID")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS terms ("
+                "term TEXT NOT NULL, doc INTEGER NOT NULL, number INTEGER NOT NULL, "
+                "tf INTEGER NOT NULL, PRIMARY KEY (term, doc, number)) WITHOUT ROWID")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+    
+    def _reader(self):
+        """當前線程的只讀連接: 只看到已提交的數據,與內存元數據一起在索引鎖下使用"""
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = self._readers.conn = sqlite3.connect(str(self.index_file))
+        return conn
+    
+    def load_index(self):
+        """打開索引文件,只讀取每個文檔和文件清單條目的元數據(posting和段落留在磁盤上),
+        損壞或版本不符時從空索引開始"""
+        # 舊版本的整體JSON索引已不再使用
+        legacy_file = self.kb_dir.parent / f"{self.kb_dir.name}_index.json"
+        if legacy_file.exists():
+            try:
+                legacy_file.unlink()
+            except OSError:
+                pass
+        
+        with self._write_lock, self._lock:
+            try:
+                conn = self._connection()
+                meta = dict(conn.execute("SELECT key, value FROM meta"))
+                if meta.get('version') != str(self.INDEX_VERSION):
+                    self._reset_index()
+                    return
+                
+                doc_names, doc_passages, doc_lengths = {}, {}, {}
+                for doc_id, name, count, length in conn.execute(
+                        "SELECT id, name, passages, length FROM documents"):
+                    doc_names[doc_id] = name
+                    doc_passages[name] = count
+                    doc_lengths[name] = length
+                
+                manifest = {path: [size, mtime_ns, digest] for path, size, mtime_ns, digest
+                            in conn.execute("SELECT path, size, mtime_ns, sha256 FROM manifest")}
+                
+                vectors_file = matrix = None
+                if NUMPY_AVAILABLE and any(doc_passages.values()):
+                    vectors_file = meta.get('vectors')
+                    matrix = self._open_matrix(vectors_file) if vectors_file else None
+                    total = matrix.shape[0] if matrix is not None else 0
+                    # 只通過行號索引檢查,不逐行讀取段落
+                    max_row, missing = conn.execute(
+                        "SELECT (SELECT MAX(row) FROM passages), "
+                        "EXISTS (SELECT 1 FROM passages WHERE row IS NULL)").fetchone()
+                    if missing or max_row is None or max_row >= total:
+                        # 向量矩陣缺失或與索引不一致(例如後來才安裝numpy),整體重建
+                        self._reset_index()
+                        return
+                
+                self._doc_names = doc_names
+                self._doc_ids = {name: doc_id for doc_id, name in doc_names.items()}
+                self.doc_passages = doc_passages
+                self._doc_lengths = doc_lengths
+                self.passage_count = sum(doc_passages.values())
+                self.total_length = sum(doc_lengths.values())
+                self.manifest = manifest
+                self.vectors_file = vectors_file
+                self._matrix = matrix
+                self._stale_rows = None
+                if NUMPY_AVAILABLE:
+                    self._remove_old_vectors()
+            except Exception as e:
+                print(f"加載知識庫索引失敗,將重建: {e}")
+                self._reset_index()
+    
+    def _reset_index(self):
+        """清空內存中的索引並重建索引文件,之後所有文件重新攝取(調用方持有寫入鎖)"""
+        with self._lock:
+            try:
+                conn = self._connection()
+                tables = [name for name, in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'")]
+                with conn:
+                    for table in tables:
+                        conn.execute(f'DROP TABLE "{table}"')
+                conn.close()
+            except sqlite3.DatabaseError:
+                # 不是有效的SQLite文件,直接刪掉
+                if self._conn is not None:
+                    self._conn.close()
+                self.index_file.unlink(missing_ok=True)
+            self._conn = None
+            conn = self._connection()
+            with conn:
+                conn.execute("INSERT INTO meta VALUES ('version', ?)", (str(self.INDEX_VERSION),))
+            
+            self._doc_ids = {}
+            self._doc_names = {}
+            self.doc_passages = {}
+            self._doc_lengths = {}
+            self.passage_count = 0
+            self.total_length = 0
+            self.manifest = {}
+            self.vectors_file = None
+            self._matrix = None
+            self._stale_rows = set()
+            self.generation += 1
+            if NUMPY_AVAILABLE:
+                self._remove_old_vectors()
+    
+    def _apply_changes(self, removed=(), indexed=(), manifest=(), documents=()):
+        """把一批變化寫入索引文件,提交事務的同時替換內存中的元數據
+        removed: 要移除的文檔名; indexed: [(文檔名, 分析結果)];
+        manifest: [(路徑, 條目或None)]; documents: 提交後登記的[(路徑, stat, 內容)]"""
+        with self._write_lock:
+            # 追加向量和執行SQL都不持有索引鎖,搜索照常進行(讀連接看不到未提交的數據)
+            assigned = self._append_vectors(indexed) if NUMPY_AVAILABLE else {}
+            dropped = set(removed) | {name for name, _ in indexed}
+            conn = self._connection()
+            try:
+                freed = [row for name in dropped for row in self._delete_document(conn, name)]
+                doc_ids = [self._insert_document(conn, name, analysis, assigned)
+                           for name, analysis in indexed]
+                for path, entry in manifest:
+                    if entry is None:
+                        conn.execute("DELETE FROM manifest WHERE path = ?", (path,))
+                    else:
+                        conn.execute("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?)", (path, *entry))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('vectors', ?)", (self.vectors_file,))
+            except Exception:
+                conn.rollback()
+                raise
+            
+            with self._lock:
+                conn.commit()
+                self.generation += 1
+                for name in dropped:
+                    self._doc_names.pop(self._doc_ids.pop(name, None), None)
+                    self.passage_count -= self.doc_passages.pop(name, 0)
+                    self.total_length -= self._doc_lengths.pop(name, 0)
+                for name in set(removed) - {name for name, _ in indexed}:
+                    self.documents.pop(name, None)
+                for (name, (_, passages)), doc_id in zip(indexed, doc_ids):
+                    self._doc_ids[name] = doc_id
+                    self._doc_names[doc_id] = name
+                    self.doc_passages[name] = len(passages)
+                    self._doc_lengths[name] = sum(sum(terms.values()) for _, _, terms, _ in passages)
+                    self.passage_count += len(passages)
+                    self.total_length += self._doc_lengths[name]
+                for path, entry in manifest:
+                    if entry is None:
+                        self.manifest.pop(path, None)
+                    else:
+                        self.manifest[path] = entry
+                for file_path, stat, content in documents:
+                    self._register_document(file_path, stat, content)
+                if NUMPY_AVAILABLE:
+                    self._sync_matrix(assigned, freed)
+                    stale = len(self._stale(conn))
+                    live = (self._matrix.shape[0] if self._matrix is not None else 0) - stale
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            
+            if NUMPY_AVAILABLE and stale > max(self.VECTOR_COMPACT_MIN, live):
+                try:
+                    self._compact_vectors()
+                except Exception as e:
+                    print(f"壓縮知識庫向量失敗: {e}")
+    
+    def _delete_document(self, conn, name):
+        """從索引文件中刪除文檔: 按索引時記錄的n-gram和詞刪除posting,不掃描整個索引;
+        返回它的段落原來在向量矩陣中的行"""
+        doc_id = self._doc_ids.get(name)
+        if doc_id is None:
+            return []
+        rows = [row for row, in conn.execute(
+            "SELECT row FROM passages WHERE doc = ? AND row IS NOT NULL", (doc_id,))]
+        row = conn.execute("SELECT grams, terms FROM doc_keys WHERE doc = ?", (doc_id,)).fetchone()
+        if row:
+            grams, passage_terms = (json.loads(zlib.decompress(data)) for data in row)
+            conn.executemany("DELETE FROM grams WHERE gram = ? AND doc = ?",
+                             ((gram, doc_id) for gram in grams))
+            conn.executemany("DELETE FROM terms WHERE term = ? AND doc = ? AND number = ?",
+                             ((term, doc_id, number)
+                              for number, terms in enumerate(passage_terms) for term in terms))
+        conn.execute("DELETE FROM passages WHERE doc = ?", (doc_id,))
+        conn.execute("DELETE FROM doc_keys WHERE doc = ?", (doc_id,))
+        conn.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+        return rows
+    
+    def _insert_document(self, conn, name, analysis, assigned):
+        """把文檔的分析結果寫入索引文件,返回文檔編號"""
+        grams, passages = analysis
+        lengths = [sum(terms.values()) for _, _, terms, _ in passages]
+        doc_id = conn.execute("INSERT INTO documents (name, passages, length) VALUES (?, ?, ?)",
+                              (name, len(passages), sum(lengths))).lastrowid
+        conn.execute("INSERT INTO doc_keys VALUES (?, ?, ?)", (doc_id, *(
+            zlib.compress(json.dumps(keys, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            for keys in (list(grams), [list(terms) for _, _, terms, _ in passages]))))
+        conn.executemany("INSERT INTO grams VALUES (?, ?)", ((gram, doc_id) for gram in grams))
+        conn.executemany("INSERT INTO terms VALUES (?, ?, ?, ?)",
+                         ((term, doc_id, number, tf)
+                          for number, (_, _, terms, _) in enumerate(passages) for term, tf in terms.items()))
+        conn.executemany("INSERT INTO passages VALUES (?, ?, ?, ?, ?, ?)",
+                         ((doc_id, number, start, end, length, assigned.get((name, number)))
+                          for number, ((start, end, _, _), length) in enumerate(zip(passages, lengths))))
+        return doc_id
+    
+    def _open_matrix(self, vectors_file):
+        """以內存映射打開向量矩陣文件,文件為空時返回None"""
+        path = self.kb_dir.parent / vectors_file
+        rows = path.stat().st_size // (4 * self.VECTOR_DIM) if path.exists() else 0
+        if not rows:
+            return None
+        return np.memmap(path, dtype=np.float32, mode='r', shape=(rows, self.VECTOR_DIM))
+    
+    def _append_vectors(self, indexed):
+        """把新段落的向量追加到矩陣文件末尾,返回 {段落: 行號}"""
+        keys = [(name, number) for name, (_, passages) in indexed for number in range(len(passages))]
+        if not keys:
+            return {}
+        block = np.stack([vector for _, (_, passages) in indexed
+                          for _, _, _, vector in passages]).astype(np.float32)
+        if self.vectors_file is None:
+            self.vectors_file = f"{self.kb_dir.name}_vectors_{time.time_ns()}.f32"
+        path = self.kb_dir.parent / self.vectors_file
+        row_bytes = 4 * self.VECTOR_DIM
+        size = path.stat().st_size if path.exists() else 0
+        first = -(-size // row_bytes)
+        with open(path, 'ab') as f:
+            # 上次追加中途中斷留下的半行補齊,作為失效行
+            f.write(bytes(first * row_bytes - size))
+            f.write(block.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return {key: first + offset for offset, key in enumerate(keys)}
+    
+    def _sync_matrix(self, assigned, freed):
+        """重新映射矩陣文件: 被刪除段落的行和沒有段落引用的新行(寫入失敗留下的)記為失效行"""
+        old_total = self._matrix.shape[0] if self._matrix is not None else 0
+        self._matrix = self._open_matrix(self.vectors_file) if self.vectors_file else None
+        if self._stale_rows is None:
+            return  # 尚未讀取,以後讀取時按索引文件的內容計算
+        total = self._matrix.shape[0] if self._matrix is not None else 0
+        used = set(assigned.values())
+        self._stale_rows.update(freed)
+        self._stale_rows.update(row for row in range(old_total, total) if row not in used)
+    
+    def _stale(self, conn):
+        """失效行 = 矩陣中沒有段落引用的行,第一次需要時掃描行號索引得出(調用方持有索引鎖)"""
+        if self._stale_rows is None:
+            total = self._matrix.shape[0] if self._matrix is not None else 0
+            live = np.zeros(total, dtype=bool)
+            live[[row for row, in conn.execute("SELECT row FROM passages WHERE row IS NOT NULL")]] = True
+            self._stale_rows = set(np.flatnonzero(~live).tolist())
+        return self._stale_rows
+    
+    def _compact_vectors(self):
+        """只保留有效行,寫成新的矩陣文件(舊文件可能仍被映射,Windows下無法原地改寫)
+        在寫入鎖內執行,段落的行號只有寫入方會修改,寫文件期間不必持有索引鎖"""
+        conn = self._connection()
+        live = conn.execute(
+            "SELECT doc, number, row FROM passages WHERE row IS NOT NULL ORDER BY row").fetchall()
+        rows = [row for _, _, row in live]
+        vectors_file = f"{self.kb_dir.name}_vectors_{time.time_ns()}.f32"
+        with open(self.kb_dir.parent / vectors_file, 'wb') as f:
+            for i in range(0, len(rows), 4096):
+                f.write(np.ascontiguousarray(self._matrix[rows[i:i + 4096]]).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        
+        try:
+            conn.executemany("UPDATE passages SET row = ? WHERE doc = ? AND number = ?",
+                             ((row, doc, number) for row, (doc, number, _) in enumerate(live)))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('vectors', ?)", (vectors_file,))
+        except Exception:
+            conn.rollback()
+            raise
+        matrix = self._open_matrix(vectors_file)
+        with self._lock:
+            conn.commit()
+            self.vectors_file = vectors_file
+            self._matrix = matrix
+            self._stale_rows = set()
+        self._remove_old_vectors()
+    
+    def _remove_old_vectors(self):
+        """刪除不再使用的舊向量矩陣文件"""
+        for path in self.kb_dir.parent.glob(f"{self.kb_dir.name}_vectors_*"):
+            if path.name != self.vectors_file:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass  # 仍被映射時留到下次壓縮或啟動時再刪
+    
+    def _candidates(self, query_lower):
+        """用倒排索引篩選可能包含查詢串的文檔(按加入順序)"""
+        grams = self._ngrams(query_lower)
+        if not grams:
+            # 查詢太短無法切分n-gram,退回全表掃描
+            return list(self.documents.keys())
+        
+        # 逐個讀取n-gram的posting求交集,交集為空時提前結束
+        conn = self._reader()
+        candidates = None
+        for gram in grams:
+            docs = {doc for doc, in conn.execute("SELECT doc FROM grams WHERE gram = ?", (gram,))}
+            candidates = docs if candidates is None else candidates & docs
+            if not candidates:
+                return []
+        names = (self._doc_names.get(doc) for doc in candidates)
+        return sorted((name for name in names if name in self.documents), key=self._doc_order.get)
+    
+    def search(self, query, max_results=3, mode=None):
+        """搜索知識庫,mode未指定時使用當前搜索模式(結果按索引版本緩存)"""
+        mode = mode or self.search_mode
+        with self._lock:
+            cache_key = (self._normalize_query(query, mode), mode, max_results, self.generation)
+            results = self._query_cache.get(cache_key)
+            if results is not None:
+                self._query_cache.move_to_end(cache_key)
+                self.cache_hits += 1
+                return list(results)
+            
+            self.cache_misses += 1
+            if mode in ('semantic', 'hybrid') and NUMPY_AVAILABLE:
+                results = self.search_vectors(query, max_results, hybrid=(mode == 'hybrid'))
+            elif mode in ('bm25', 'semantic', 'hybrid'):
+                results = self.search_bm25(query, max_results)
+            else:
+                results = self.search_keyword(query, max_results)
+            
+            # 索引已變化的舊條目不會再命中,直接清掉
+            if self._query_cache and next(iter(self._query_cache))[3] != self.generation:
+                self._query_cache.clear()
+            self._query_cache[cache_key] = results
+            if len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        
+        self._refresh_missing()
+        return list(results)
+    
+    def _normalize_query(self, query, mode):
+        """歸一化查詢: 關鍵詞模式不區分大小寫,其他模式還忽略多餘空白"""
+        if mode == 'keyword':
+            return query.lower()
+        return ' '.join(query.lower().split())
+    
+    def search_keyword(self, query, max_results=3):
+        """關鍵詞搜索(倒排索引篩選候選,再精確計數)"""
+        results = []
+        query_lower = query.lower()
+        
+        for filename in self._candidates(query_lower):
+            doc = self.documents[filename]
+            content = self._load_content(doc)
+            if content is None:
+                continue
+            content_lower = content.lower()
+            if query_lower in content_lower:
+                # 計算相關度(簡單的出現次數)
+                relevance = content_lower.count(query_lower)
+                # 提取相關片段
+                snippets = self._extract_snippets(content, query, num_snippets=2)
+                results.append({
+                    'filename': filename,
+                    'relevance': relevance,
+                    'snippets': snippets,
+                    'path': doc['path']
+                })
+        
+        # 按相關度排序
+        results.sort(key=lambda x: x['relevance'], reverse=True)
+        return results[:max_results]
+    
+    def search_bm25(self, query, max_results=3):
+        """BM25多詞排序搜索,以段落為單位打分並直接返回段落"""
+        scores = self._bm25_scores(query)
+        # 用堆取前k個,避免對所有段落排序
+        top = heapq.nlargest(max_results, scores.items(), key=lambda item: item[1])
+        results = (self._passage_result(key, score) for key, score in top)
+        return [result for result in results if result]
+    
+    def _bm25_scores(self, query, rows=None):
+        """計算查詢命中的每個段落的BM25分數,只讀取查詢詞的posting;
+        rows不為None時同時記下命中段落在向量矩陣中的行號"""
+        query_terms = set(self._tokenize(query))
+        num_passages = self.passage_count
+        if not query_terms or not num_passages:
+            return {}
+        
+        avg_length = self.total_length / num_passages or 1
+        k1, b = self.BM25_K1, self.BM25_B
+        conn = self._reader()
+        scores = {}
+        
+        for term in query_terms:
+            postings = conn.execute(
+                "SELECT t.doc, t.number, t.tf, p.length, p.row FROM terms t "
+                "JOIN passages p ON p.doc = t.doc AND p.number = t.number WHERE t.term = ?",
+                (term,)).fetchall()
+            if not postings:
+                continue
+            idf = math.log(1 + (num_passages - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, number, tf, length, row in postings:
+                key = (self._doc_names[doc], number)
+                norm = k1 * (1 - b + b * length / avg_length)
+                scores[key] = scores.get(key, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+                if rows is not None:
+                    rows[key] = row
+        return scores
+    
+    def search_vectors(self, query, max_results=3, hybrid=False):
+        """語義檢索: 一次矩陣向量乘法算出所有段落的相似度,再部分排序取前k個"""
+        query_vector = self._embed_terms(Counter(self._tokenize(query)))
+        
+        if self._matrix is None:
+            return []
+        conn = self._reader()
+        scores = self._matrix @ query_vector
+        stale = self._stale(conn)
+        if stale:
+            scores[list(stale)] = -np.inf
+        
+        if hybrid:
+            rows = {}
+            bm25_scores = self._bm25_scores(query, rows)
+            if bm25_scores:
+                weight = self.HYBRID_BM25_WEIGHT
+                top_bm25 = max(bm25_scores.values())
+                lexical = np.zeros_like(scores)
+                for key, score in bm25_scores.items():
+                    lexical[rows[key]] = score / top_bm25
+                scores = weight * lexical + (1 - weight) * scores
+        
+        k = min(max_results, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        # 只為前k行反查段落
+        results = []
+        for row in top:
+            if scores[row] > 0:
+                doc, number = conn.execute("SELECT doc, number FROM passages WHERE row = ?",
+                                           (int(row),)).fetchone()
+                result = self._passage_result((self._doc_names[doc], number), float(scores[row]))
+                if result:
+                    results.append(result)
+        return results
+    
+    def _passage_result(self, key, score):
+        """組裝單個段落的搜索結果,文件已無法讀取時返回None"""
+        filename, number = key
+        doc = self.documents[filename]
+        content = self._load_content(doc)
+        if content is None:
+            return None
+        start, end = self._reader().execute(
+            "SELECT start_offset, end_offset FROM passages WHERE doc = ? AND number = ?",
+            (self._doc_ids[filename], number)).fetchone()
+        passage = {'start': start, 'end': end}
+        return {
+            'filename': filename,
+            'relevance': round(score, 3),
+            'snippets': [self._passage_text(content, passage)],
+            'path': doc['path'],
+            'start': passage['start'],
+            'end': passage['end']
+        }
+    
+    def _load_content(self, doc):
+        """讀取文檔內容(懶加載模式下從磁盤讀取),讀取失敗時記下路徑並返回None"""
+        try:
+            return doc['content']
+        except OSError as e:
+            print(f"無法讀取 {doc['path']}: {e}")
+            self._missing_paths.add(doc['path'])
+            return None
+    
+    def _refresh_missing(self):
+        """文件在監視器處理之前就被刪除或移走了: 交給update_files在後台從索引中移除"""
+        with self._lock:
+            missing, self._missing_paths = self._missing_paths, set()
+        if missing:
+            threading.Thread(target=self.update_files, args=(missing,), daemon=True).start()
+    
+    def _passage_text(self, content, passage):
+        """按偏移取出段落文本,首尾不完整時加省略號"""
+        text = content[passage['start']:passage['end']].strip()
+        if passage['start'] > 0:
+            text = "..." + text
+        if passage['end'] < len(content):
+            text = text + "..."
+        return text
+    
+    def _extract_snippets(self, content, query, num_snippets=2, context_chars=100):
+        """提取包含查詢詞的文本片段"""
+        snippets = []
+        query_lower = query.lower()
+        content_lower = content.lower()
+        
+        start = 0
+        for _ in range(num_snippets):
+            pos = content_lower.find(query_lower, start)
+            if pos == -1:
+                break
+            
+            snippet_start = max(0, pos - context_chars)
+            snippet_end = min(len(content), pos + len(query) + context_chars)
+            snippet = content[snippet_start:snippet_end]
+            
+            if snippet_start > 0:
+                snippet = "..." + snippet
+            if snippet_end < len(content):
+                snippet = snippet + "..."
+            
+            snippets.append(snippet)
+            start = pos + len(query)
+        
+        return snippets
+    
+    def get_all_documents(self):
+        """獲取所有文檔列表"""
+        with self._lock:
+            return list(self.documents.keys())
+    
+    def get_document_content(self, filename):
+        """獲取文檔全文,文檔不存在時返回None"""
+        with self._lock:
+            doc = self.documents.get(filename)
+            content = self._load_content(doc) if doc else None
+        self._refresh_missing()
+        return content
+
+
+class KnowledgeBaseWatcher:
+    """監視知識庫目錄,把增刪改事件去抖並合併後交給KnowledgeBase增量更新"""
+    
+    POLL_INTERVAL = 2.0  # 輪詢模式的掃描間隔(秒)
+    DEBOUNCE_SECONDS = 1.0  # 最後一個事件之後需要保持安靜的時間(秒)
+    WATCHED_EVENTS = ('created', 'modified', 'deleted', 'moved')
+    
+    def __init__(self, kb):
+        self.kb = kb
+        self.pending = set()
+        self.quiet_period = self.DEBOUNCE_SECONDS
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._last_event = 0.0
+        self._observer = None
+        self._snapshot = {}
+    
+    def start(self):
+        """啟動監視: 有watchdog時使用系統文件通知(inotify等),否則輪詢"""
+        if WATCHDOG_AVAILABLE:
+            watcher = self
+            
+            class Handler(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    if event.event_type not in watcher.WATCHED_EVENTS:
+                        return
+                    # 目錄的modified只表示其中有文件變化(文件另有事件);
+                    # 目錄被刪除或移動時不會逐個文件通知,交給update_files展開
+                    if event.is_directory and event.event_type == 'modified':
+                        return
+                    watcher.notify([event.src_path, getattr(event, 'dest_path', '')])
+            
+            self._observer = Observer()
+            self._observer.daemon = True
+            self._observer.schedule(Handler(), str(self.kb.kb_dir), recursive=True)
+            self._observer.start()
+        else:
+            # 輪詢要到下一次掃描才能發現後續變化,安靜時間需要覆蓋一個掃描間隔
+            self.quiet_period = max(self.DEBOUNCE_SECONDS, self.POLL_INTERVAL * 1.5)
+            self._snapshot = self._scan()
+            threading.Thread(target=self._poll_loop, daemon=True).start()
+        
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+    
+    def stop(self):
+        """停止監視"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._observer:
+            self._observer.stop()
+    
+    def notify(self, paths):
+        """記錄發生變化的路徑,並重新開始計算安靜時間"""
+        with self._lock:
+            self.pending.update(path for path in paths if path)
+            self._last_event = time.monotonic()
+        self._wakeup.set()
+    
+    def _scan(self):
+        """輪詢模式: 遞歸收集目錄下每個文件的(大小, 修改時間)"""
+        snapshot = {}
+        stack = [str(self.kb.kb_dir)]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            stat = entry.stat()
+                            snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        continue
+        return snapshot
+    
+    def _poll_loop(self):
+        """輪詢模式: 定期對比目錄快照"""
+        while not self._stopped.wait(self.POLL_INTERVAL):
+            snapshot = self._scan()
+            changed = [path for path in snapshot.keys() | self._snapshot.keys()
+                       if snapshot.get(path) != self._snapshot.get(path)]
+            self._snapshot = snapshot
+            if changed:
+                self.notify(changed)
+    
+    def _dispatch_loop(self):
+        """事件停止一段時間後,把累積的變化一次性交給知識庫"""
+        while True:
+            self._wakeup.wait()
+            if self._stopped.is_set():
+                return
+            
+            # 批量複製文件時事件會持續到來,等到安靜下來才處理
+            while True:
+                with self._lock:
+                    remaining = self._last_event + self.quiet_period - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self._stopped.wait(remaining):
+                    return
+            
+            with self._lock:
+                paths, self.pending = self.pending, set()
+                self._wakeup.clear()
+            
+            try:
+                self.kb.update_files(paths)
+                self.kb.wait_until_ready()
+            except Exception as e:
+                print(f"更新知識庫索引失敗: {e}")
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """記錄建立連接(TCP+TLS握手)耗時的HTTPS連接"""
+    
+    timings = threading.local()
+    
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        TimedHTTPSConnection.timings.connect_time = time.perf_counter() - started
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    """使用TimedHTTPSConnection的連接池"""
+    
+    ConnectionCls = TimedHTTPSConnection
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPS請求走可計時連接池的適配器"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            **self.poolmanager.pool_classes_by_scheme,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+class APIClient:
+    """共享的HTTP客戶端: 所有請求復用同一個keep-alive連接池,並分開記錄連接和服務器耗時"""
+    
+    BASE_URL = "https://openrouter.ai/api/v1"
+    POOL_SIZE = 8  # 同一主機最多保持的連接數,足夠並發的對話、總結和批量任務
+    
+    def __init__(self):
+        # 連接池在適配器中,可跨線程共享;Session本身不保證線程安全,每個線程各用一個
+        self.adapter = PooledHTTPAdapter(pool_connections=2, pool_maxsize=self.POOL_SIZE)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.last_connect_time = None  # 最近一次請求新建連接的耗時(秒),復用連接時為0
+        self.last_server_time = None  # 最近一次請求從發出到收到響應頭的耗時(秒,不含建連)
+        self.connections_opened = 0
+        self.requests_sent = 0
+    
+    @property
+    def session(self):
+        """當前線程的Session(共享同一個連接池)"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('https://', self.adapter)
+            self._local.session = session
+        return session
+    
+    def post(self, path, headers, json_data, stream=False, timeout=None):
+        """發送POST請求"""
+        TimedHTTPSConnection.timings.connect_time = 0.0
+        response = self.session.post(self.BASE_URL + path, headers=headers,
+                                     json=json_data, stream=stream, timeout=timeout)
+        self._record_timing(response)
+        return response
+    
+    def _record_timing(self, response):
+        """記錄本次請求的建連耗時和服務器耗時"""
+        connect_time = TimedHTTPSConnection.timings.connect_time
+        with self._lock:
+            self.requests_sent += 1
+            if connect_time:
+                self.connections_opened += 1
+            self.last_connect_time = connect_time
+            self.last_server_time = max(0.0, response.elapsed.total_seconds() - connect_time)
+    
+    def warm_up(self):
+        """在後台預先建立到API服務器的連接,第一條消息不必再等握手"""
+        def do_warm_up():
+            try:
+                TimedHTTPSConnection.timings.connect_time = 0.0
+                self.session.head(self.BASE_URL + "/models", timeout=10)
+                with self._lock:
+                    if TimedHTTPSConnection.timings.connect_time:
+                        self.connections_opened += 1
+            except requests.RequestException as e:
+                print(f"預熱連接失敗: {e}")
+        
+        threading.Thread(target=do_warm_up, daemon=True).start()
+
+
+class RequestScheduler:
+    """API請求調度: 令牌桶限速,遵守Retry-After和限流響應頭,指數退避重試,每次嘗試單獨超時"""
+    
+    RETRY_STATUS = {408, 429, 500, 502, 503, 504, 529}
+    MAX_RETRIES = 4
+    BACKOFF_BASE = 1.0  # 秒
+    BACKOFF_CAP = 30.0
+    MAX_SERVER_WAIT = 120.0  # 服務器要求等待更久時不再重試,直接報錯
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 300  # 非流式請求要等整條回復生成完才有響應頭
+    STREAM_READ_TIMEOUT = 60  # 流式請求兩次數據之間的最長間隔
+    BURST = 5
+    
+    def __init__(self, client, requests_per_minute=60):
+        self.client = client
+        self.rate = requests_per_minute / 60.0
+        self._tokens = float(self.BURST)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0  # 被限流後所有請求暫停到此時刻
+        self._lock = threading.Lock()
+        self.waiting = 0  # 正在等待令牌或退避的請求數
+        self.retries = 0
+        self.on_change = None
+    
+    def post(self, path, headers, json_data, stream=False, token=None):
+        """發送POST請求,遇到限流、服務器錯誤和網絡錯誤時自動重試"""
+        timeout = (self.CONNECT_TIMEOUT, self.STREAM_READ_TIMEOUT if stream else self.READ_TIMEOUT)
+        attempt = 0
+        while True:
+            self._acquire(token)
+            try:
+                response = self.client.post(path, headers, json_data, stream=stream, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if token:
+                    token.raise_if_cancelled()
+                if attempt >= self.MAX_RETRIES:
+                    raise
+                delay = self._backoff(attempt)
+            else:
+                if token:
+                    token.attach(response)
+                server_delay = self._observe_limits(response)
+                if response.status_code not in self.RETRY_STATUS or attempt >= self.MAX_RETRIES:
+                    return response
+                if server_delay is not None and server_delay > self.MAX_SERVER_WAIT:
+                    return response
+                delay = self._backoff(attempt) if server_delay is None else server_delay
+                response.close()
+            
+            attempt += 1
+            with self._lock:
+                self.retries += 1
+            self._wait(delay, token)
+    
+    def _backoff(self, attempt):
+        """指數退避,full jitter避免多個請求同時重試"""
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * 2 ** attempt))
+    
+    def _observe_limits(self, response):
+        """讀取限流響應頭,返回服務器要求的等待秒數(沒有時為None)"""
+        headers = response.headers
+        delay = None
+        retry_after = headers.get('Retry-After')
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    pass
+        
+        reset = headers.get('X-RateLimit-Reset')
+        if delay is None and reset and (response.status_code == 429 or
+                                        headers.get('X-RateLimit-Remaining') == '0'):
+            try:
+                value = float(reset)
+                if value > 1e12:  # 毫秒時間戳
+                    value /= 1000
+                delay = value - time.time() if value > 1e9 else value
+            except ValueError:
+                pass
+        
+        if delay is None:
+            return None
+        delay = max(0.0, delay)
+        if response.status_code == 429 or headers.get('X-RateLimit-Remaining') == '0':
+            # 額度用完: 其他請求也一起暫停,不要繼續撞限流
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+    
+    def _acquire(self, token=None):
+        """從令牌桶取一個令牌,沒有時等待"""
+        self._set_waiting(1)
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    self._tokens = min(self.BURST, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    wait = self._paused_until - now
+                    if wait <= 0:
+                        if self._tokens >= 1:
+                            self._tokens -= 1
+                            return
+                        wait = (1 - self._tokens) / self.rate
+                self._wait(wait, token)
+        finally:
+            self._set_waiting(-1)
+    
+    def _wait(self, seconds, token=None):
+        if token:
+            token.wait(seconds)
+            token.raise_if_cancelled()
+        else:
+            time.sleep(seconds)
+    
+    def _set_waiting(self, change):
+        with self._lock:
+            self.waiting += change
+        if self.on_change:
+            self.on_change()
+
+
+class RequestCancelled(Exception):
+    """請求已被取消,partial_text是取消前已收到的文本"""
+    
+    def __init__(self, partial_text=""):
+        super().__init__("請求已取消")
+        self.partial_text = partial_text
+
+
+class CancelToken:
+    """單個請求的取消令牌: cancel()會關閉正在讀取的響應,讓阻塞的讀取立即返回"""
+    
+    def __init__(self):
+        self.cancelled = False
+        self._response = None
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+    
+    def attach(self, response):
+        """綁定正在讀取的響應"""
+        with self._lock:
+            self._response = response
+            cancelled = self.cancelled
+        if cancelled:
+            response.close()
+    
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            response = self._response
+        self._event.set()
+        if response is not None:
+            response.close()
+    
+    def wait(self, seconds):
+        """等待指定秒數,被取消時提前返回"""
+        self._event.wait(seconds)
+    
+    def raise_if_cancelled(self, partial_text=""):
+        if self.cancelled:
+            raise RequestCancelled(partial_text)
+
+
+class AsyncRequestEngine:
+    """在後台線程運行的asyncio事件循環,統一調度所有API請求
+    
+    - 信號量限制同時進行的請求數,超出的在事件循環中排隊,不佔線程
+    - 同一channel的請求按提交順序逐個執行(例如對話必須等上一條回復完成)
+    - 每個請求有自己的CancelToken,可以隨時取消
+    - 結果和異常通過root.after回到Tk主線程
+    """
+    
+    MAX_CONCURRENCY = APIClient.POOL_SIZE  # 與連接池大小一致,請求不必等待空閒連接
+    
+    def __init__(self, root, max_concurrency=None):
+        self.root = root
+        self.max_concurrency = max_concurrency or self.MAX_CONCURRENCY
+        self.loop = asyncio.new_event_loop()
+        # 阻塞的HTTP讀取在有界線程池中進行,線程數不隨請求數增長
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency,
+                                            thread_name_prefix="api")
+        self.loop.set_default_executor(self._executor)
+        self._channel_locks = {}
+        self._tokens = {}  # channel -> 尚未完成的請求令牌
+        self._tokens_lock = threading.Lock()
+        self.pending = 0  # 已提交但尚未完成的請求數
+        self.running = 0
+        self.on_change = None
+        
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run_loop, args=(ready,), daemon=True)
+        self._thread.start()
+        ready.wait()
+    
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        ready.set()
+        self.loop.run_forever()
+    
+    def submit(self, job, on_success=None, on_error=None, on_cancel=None, channel=None):
+        """提交請求,job(token)在工作線程中執行,回調在Tk主線程中執行,返回CancelToken"""
+        token = CancelToken()
+        with self._tokens_lock:
+            self.pending += 1
+            self._tokens.setdefault(channel, []).append(token)
+        asyncio.run_coroutine_threadsafe(
+            self._run_job(job, token, on_success, on_error, on_cancel, channel), self.loop)
+        self._notify()
+        return token
+    
+    @property
+    def queued(self):
+        """等待執行的請求數"""
+        return self.pending - self.running
+    
+    def cancel_channel(self, channel=None):
+        """取消某個channel中所有排隊和進行中的請求"""
+        with self._tokens_lock:
+            tokens = list(self._tokens.get(channel, []))
+        # 從最後提交的開始取消,避免正在執行的請求結束後排隊的請求趁機開始
+        for token in reversed(tokens):
+            token.cancel()
+        return len(tokens)
+    
+    def has_pending(self, channel=None):
+        with self._tokens_lock:
+            return bool(self._tokens.get(channel))
+    
+    async def _run_job(self, job, token, on_success, on_error, on_cancel, channel):
+        try:
+            if channel is None:
+                await self._execute(job, token, on_success, on_error, on_cancel)
+            else:
+                lock = self._channel_locks.setdefault(channel, asyncio.Lock())
+                async with lock:
+                    await self._execute(job, token, on_success, on_error, on_cancel)
+        finally:
+            with self._tokens_lock:
+                self.pending -= 1
+                self._tokens[channel].remove(token)
+            self._notify()
+    
+    async def _execute(self, job, token, on_success, on_error, on_cancel):
+        async with self._semaphore:
+            with self._tokens_lock:
+                self.running += 1
+            try:
+                token.raise_if_cancelled()
+                result = await self.loop.run_in_executor(None, job, token)
+            except RequestCancelled as e:
+                self._callback(on_cancel, e)
+            except Exception as e:
+                if token.cancelled:
+                    self._callback(on_cancel, RequestCancelled())
+                else:
+                    self._callback(on_error, e)
+            else:
+                self._callback(on_success, result)
+            finally:
+                with self._tokens_lock:
+                    self.running -= 1
+    
+    def _notify(self):
+        if self.on_change is not None:
+            self.root.after(0, self.on_change)
+    
+    def _callback(self, callback, value):
+        if callback is not None:
+            self.root.after(0, callback, value)
+
+
+class ContextWindowManager:
+    """按token預算組裝每次請求的對話上下文
+    
+    - 每條消息的token估算值緩存在消息的'_tokens'鍵中,只估算一次
+    - 最近的PINNED_MESSAGES條消息總是保留,超出預算時從最舊的消息開始捨棄
+    - 裁剪點是粘性的: 超出預算時一次裁到低水位,之後不隨每輪移動,
+      請求的前綴保持穩定,Prompt Caching才能繼續命中
+    """
+    
+    DEFAULT_BUDGET = 60000  # 輸入token預算(含System Prompt)
+    PINNED_MESSAGES = 4
+    LOW_WATER = 0.7
+    IMAGE_TOKENS = 1600  # 圖片按長邊1568像素時的上限估算
+    MESSAGE_OVERHEAD = 4
+    CJK_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uff00-\uffef]')
+    
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self._start = None  # 當前保留的第一條消息
+        self.dropped = 0  # 最近一次請求捨棄的消息數
+        self.last_tokens = 0  # 最近一次請求的估算輸入token數
+    
+    @classmethod
+    def estimate_text(cls, text):
+        """估算文本token數: 中日韓字符約每字1個,其他約每4個字符1個"""
+        cjk = len(cls.CJK_PATTERN.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+    
+    @classmethod
+    def block_tokens(cls, item):
+        """單個內容塊的token估算值"""
+        if item.get('type') == 'image':
+            return cls.IMAGE_TOKENS
+        return cls.estimate_text(item.get('text', ''))
+    
+    @classmethod
+    def content_tokens(cls, content):
+        """消息內容的token估算值"""
+        if isinstance(content, str):
+            return cls.estimate_text(content) + cls.MESSAGE_OVERHEAD
+        return sum(cls.block_tokens(item) for item in content) + cls.MESSAGE_OVERHEAD
+    
+    @classmethod
+    def message_tokens(cls, message):
+        """消息的token估算值(緩存在消息上)"""
+        tokens = message.get('_tokens')
+        if tokens is None:
+            tokens = cls.content_tokens(message['content'])
+            message['_tokens'] = tokens
+        return tokens
+    
+    @staticmethod
+    def strip_private(message):
+        """去掉以下劃線開頭的本地字段,它們不發送給API"""
+        return {key: value for key, value in message.items() if not key.startswith('_')}
+    
+    def reset(self):
+        self._start = None
+        self.dropped = 0
+    
+    def build(self, history, reserved_tokens=0):
+        """返回本次請求要發送的消息列表,reserved_tokens為System Prompt等固定開銷"""
+        budget = max(0, self.budget - reserved_tokens)
+        start = 0
+        for index, message in enumerate(history):
+            if message is self._start:
+                start = index
+                break
+        
+        total = sum(self.message_tokens(message) for message in history[start:])
+        if total > budget:
+            pinned_from = max(start, len(history) - self.PINNED_MESSAGES)
+            target = budget * self.LOW_WATER
+            while start < pinned_from and total > target:
+                total -= self.message_tokens(history[start])
+                start += 1
+            self._start = history[start] if start else None
+        
+        # 對話必須以用戶消息開頭(恢復的會話也可能從助手消息開始)
+        while start < len(history) - 1 and history[start]['role'] != 'user':
+            total -= self.message_tokens(history[start])
+            start += 1
+        
+        self.dropped = start
+        self.last_tokens = total + reserved_tokens
+        return [self.strip_private(message) for message in history[start:]]
+
+
+class PromptCachePlanner:
+    """在請求的穩定前綴上放置Prompt Caching斷點,並根據返回的usage統計命中率
+    
+    斷點(最多MAX_BREAKPOINTS個)按優先級選擇:
+    最後一條用戶消息(寫入本輪前綴) > System Prompt > 最後一條助手回復 > 大的知識庫/文檔內容塊。
+    每個前綴位置的哈希會被記住,下一次請求時前綴相同的最長位置即為預期能從緩存讀取的token數。
+    """
+    
+    MAX_BREAKPOINTS = 4  # Anthropic每個請求最多4個cache_control斷點
+    LARGE_BLOCK_TOKENS = 1024  # 小於最小可緩存長度的內容塊不單獨設斷點
+    CACHE_TTL = 300  # ephemeral緩存約5分鐘過期
+    
+    def __init__(self):
+        self._written = {}  # 前綴哈希 -> (前綴token數, 寫入時間)
+        self.expected_read_tokens = 0
+        self.actual_read_tokens = 0
+    
+    def plan(self, system_content, messages):
+        """給system_content和messages加上cache_control,返回用於統計命中的計劃
+        
+        messages中被修改的消息和內容塊都會先複製,不影響對話歷史
+        """
+        # 候選位置: (優先級, 位置),位置為('system', i)或('message', 消息序號, 塊序號)
+        candidates = []
+        if messages:
+            candidates.append((0, ('message', len(messages) - 1, -1)))
+        if system_content:
+            candidates.append((1, ('system', len(system_content) - 1)))
+        for index in range(len(messages) - 1, -1, -1):
+            if messages[index]['role'] == 'assistant':
+                candidates.append((2, ('message', index, -1)))
+                break
+        large_blocks = []
+        for index, message in enumerate(messages[:-1]):
+            content = message['content']
+            blocks = [{'type': 'text', 'text': content}] if isinstance(content, str) else content
+            for block_index, item in enumerate(blocks):
+                tokens = ContextWindowManager.block_tokens(item)
+                if item.get('type') == 'text' and tokens >= self.LARGE_BLOCK_TOKENS:
+                    large_blocks.append((tokens, ('message', index, block_index)))
+        # 越靠後的大塊覆蓋的前綴越長
+        large_blocks.sort(key=lambda block: block[1][1:], reverse=True)
+        candidates.extend((3, position) for tokens, position in large_blocks)
+        
+        chosen = []
+        for _, position in sorted(candidates, key=lambda candidate: candidate[0]):
+            if position not in chosen:
+                chosen.append(position)
+            if len(chosen) == self.MAX_BREAKPOINTS:
+                break
+        
+        for position in chosen:
+            if position[0] == 'system':
+                system_content[position[1]] = {**system_content[position[1]],
+                                               'cache_control': {'type': 'ephemeral'}}
+            else:
+                self._mark_message(messages, position[1], position[2])
+        
+        return self._prefix_hashes(system_content, messages)
+    
+    @staticmethod
+    def _mark_message(messages, index, block_index):
+        message = messages[index]
+        content = message['content']
+        if isinstance(content, str):
+            content = [{'type': 'text', 'text': content}]
+        else:
+            content = list(content)
+        content[block_index] = {**content[block_index], 'cache_control': {'type': 'ephemeral'}}
+        messages[index] = {**message, 'content': content}
+    
+    @classmethod
+    def canonical(cls, value):
+        """去掉cache_control標記並統一內容格式,用於比較請求是否相同"""
+        # 字符串內容和單個文本塊對API是同一個前綴
+        if isinstance(value, dict) and isinstance(value.get('content'), str):
+            value = {**value, 'content': [{'type': 'text', 'text': value['content']}]}
+        if isinstance(value, list):
+            return [cls.canonical(item) for item in value]
+        if isinstance(value, dict):
+            return {key: cls.canonical(item) for key, item in value.items() if key != 'cache_control'}
+        return value
+    
+    @classmethod
+    def _prefix_hashes(cls, system_content, messages):
+        """每個消息邊界處前綴的(哈希, token數),忽略cache_control標記"""
+        canonical = cls.canonical
+        digest = hashlib.sha256()
+        digest.update(json.dumps(canonical(system_content), sort_keys=True).encode('utf-8'))
+        tokens = sum(ContextWindowManager.block_tokens(item) for item in system_content)
+        prefixes = []
+        for message in messages:
+            digest.update(json.dumps(canonical(message), sort_keys=True).encode('utf-8'))
+            tokens += ContextWindowManager.content_tokens(message['content'])
+            prefixes.append((digest.hexdigest(), tokens))
+        return prefixes
+    
+    def observe(self, prefixes, usage):
+        """對比本次請求預期的緩存讀取量和實際的cache_read_input_tokens"""
+        now = time.time()
+        self._written = {key: value for key, value in self._written.items()
+                         if now - value[1] < self.CACHE_TTL}
+        expected = 0
+        for key, tokens in prefixes:
+            # 不足最小可緩存長度的前綴不會被緩存
+            if key in self._written and tokens >= self.LARGE_BLOCK_TOKENS:
+                expected = max(expected, tokens)
+        
+        self.expected_read_tokens += expected
+        self.actual_read_tokens += usage.get('cache_read_input_tokens', 0)
+        
+        # 本次請求的各前綴都已寫入或讀取過緩存(只有最後的斷點之前的部分會被緩存)
+        for key, tokens in prefixes:
+            self._written[key] = (tokens, now)
+    
+    @property
+    def hit_rate(self):
+        """實際讀取量 / 預期讀取量,沒有預期時為None"""
+        if not self.expected_read_tokens:
+            return None
+        return min(1.0, self.actual_read_tokens / self.expected_read_tokens)
+
+
+class RollingSummarizer:
+    """滾動摘要: 保存一份對話摘要和水位線,每次只把水位線之後的新消息合併進摘要
+    
+    摘要的成本只與新增內容成正比,不必每次重新總結整段對話。
+    """
+    
+    TRIGGER_TOKENS = 6000  # 水位線之後(不含最近幾條)累計超過此值時自動合併
+    KEEP_RECENT = ContextWindowManager.PINNED_MESSAGES  # 最近的消息留在上下文中,不急於合併
+    
+    def __init__(self):
+        self.summary = ""
+        self.watermark = 0  # conversation_history中已合併進摘要的消息數
+        self._last_folded = None
+        self.running = False
+    
+    def reset(self):
+        self.summary = ""
+        self.watermark = 0
+        self._last_folded = None
+    
+    @staticmethod
+    def message_text(message):
+        """消息的文本內容,包含多部分消息中的文本,圖片以佔位符表示"""
+        content = message['content']
+        if isinstance(content, str):
+            return content
+        parts = []
+        for item in content:
+            if item.get('type') == 'text':
+                parts.append(item['text'])
+            elif item.get('type') == 'image':
+                parts.append("[圖片]")
+        return '\n'.join(parts)
+    
+    def _validate(self, history):
+        """對話歷史被替換或清空時重新定位水位線"""
+        if not self.watermark:
+            return
+        if self.watermark <= len(history) and history[self.watermark - 1] is self._last_folded:
+            return
+        for index, message in enumerate(history):
+            if message is self._last_folded:
+                self.watermark = index + 1
+                return
+        self.reset()
+    
+    def covered(self, history):
+        """開頭有多少條消息已合併進摘要"""
+        self._validate(history)
+        return self.watermark if self.summary else 0
+    
+    def pending_tokens(self, history):
+        """水位線之後、最近幾條之前的消息的token數"""
+        self._validate(history)
+        end = len(history) - self.KEEP_RECENT
+        return sum(ContextWindowManager.message_tokens(message)
+                   for message in history[self.watermark:end])
+    
+    def prepare(self, history, include_recent=False):
+        """返回(要合併的新消息, 摘要請求),沒有新內容時返回(None, None)"""
+        self._validate(history)
+        end = len(history) if include_recent else len(history) - self.KEEP_RECENT
+        new_messages = history[self.watermark:end]
+        if not new_messages:
+            return None, None
+        
+        conversation_text = ""
+        for message in new_messages:
+            conversation_text += f"{message['role']}: {self.message_text(message)}\n\n"
+        
+        if self.summary:
+            prompt = f"""以下是之前對話的摘要:
+
+{self.summary}
+
+以下是之後的新對話內容:
+
+{conversation_text}
+
+請把新內容合併進摘要,輸出更新後的完整摘要,保留關鍵信息和重要結論。
+
+請用2-3個段落總結,每個段落不超過100字。"""
+        else:
+            prompt = f"""請簡潔地總結以下對話的核心內容,提取關鍵信息和重要結論:
+
+{conversation_text}
+
+請用2-3個段落總結,每個段落不超過100字。"""
+        return new_messages, prompt
+    
+    def fold_units(self, new_messages):
+        """新內容太長時交給MapReduceSummarizer的分塊單位: 之前的摘要和每條消息"""
+        units = [f"之前對話的摘要:\n{self.summary}"] if self.summary else []
+        units.extend(f"{message['role']}: {self.message_text(message)}" for message in new_messages)
+        return units
+    
+    def commit(self, history, new_messages, summary):
+        """摘要生成後推進水位線,合併期間對話被清空時丟棄結果"""
+        last = new_messages[-1]
+        for index, message in enumerate(history):
+            if message is last:
+                self.summary = summary.strip()
+                self.watermark = index + 1
+                self._last_folded = last
+                return True
+        return False
+
+
+class MapReduceSummarizer:
+    """分層map-reduce摘要: 超出單次上下文的對話或文檔先按消息/段落邊界分塊,
+    並發總結各塊(map),再合併部分摘要(reduce);部分摘要仍然太長時繼續分層合併。
+    
+    所有回調都在Tk主線程中執行,狀態不需要加鎖。
+    """
+    
+    CHUNK_TOKENS = 12000  # 每塊的token上限,留出足夠餘量給提示詞和輸出
+    MAX_PARALLEL = 4
+    
+    def __init__(self, engine, summarize, on_progress=None):
+        self.engine = engine
+        self.summarize = summarize  # summarize(prompt, token),在工作線程中執行
+        self.on_progress = on_progress  # on_progress(說明, 已完成, 總數)
+        self.cancelled = False
+        self._queue = []
+        self._in_flight = {}
+        self._failed = False
+    
+    @staticmethod
+    def split_units(text):
+        """把長文本按段落切成分塊單位"""
+        return [part for part in re.split(r'\n\s*\n', text) if part.strip()]
+    
+    @classmethod
+    def chunk(cls, units):
+        """把單位依次裝進不超過CHUNK_TOKENS的塊,單個過長的單位按字符切開"""
+        chunks = []
+        current = []
+        current_tokens = 0
+        for unit in units:
+            tokens = ContextWindowManager.estimate_text(unit)
+            pieces = [unit]
+            if tokens > cls.CHUNK_TOKENS:
+                count = math.ceil(tokens / cls.CHUNK_TOKENS)
+                size = math.ceil(len(unit) / count)
+                pieces = [unit[i:i + size] for i in range(0, len(unit), size)]
+            for piece in pieces:
+                piece_tokens = ContextWindowManager.estimate_text(piece)
+                if current and current_tokens + piece_tokens > cls.CHUNK_TOKENS:
+                    chunks.append('\n\n'.join(current))
+                    current = []
+                    current_tokens = 0
+                current.append(piece)
+                current_tokens += piece_tokens
+        if current:
+            chunks.append('\n\n'.join(current))
+        return chunks
+    
+    def run(self, units, kind, on_done, on_error=None, on_cancel=None):
+        """總結units,kind描述內容(例如"對話"),完成後調用on_done(摘要)"""
+        self.kind = kind
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_cancel = on_cancel
+        self._level(units, 1, partial=False)
+    
+    def cancel(self):
+        self.cancelled = True
+        self._queue.clear()
+        for token in list(self._in_flight.values()):
+            token.cancel()
+        if self.on_cancel:
+            self.on_cancel(RequestCancelled())
+    
+    def _level(self, units, level, partial):
+        chunks = self.chunk(units)
+        if not chunks:
+            # 沒有可總結的內容(例如只有空白),不發請求直接結束
+            self._finished("")
+            return
+        if len(chunks) == 1:
+            # 一次放得下: 直接生成最終摘要
+            if partial:
+                prompt = f"""以下是一段{self.kind}各部分的摘要,請合併成一份完整的總結,提取關鍵信息和重要結論:
+
+{chunks[0]}
+
+請用2-3個段落總結,每個段落不超過100字。"""
+            else:
+                prompt = f"""請簡潔地總結以下{self.kind}的核心內容,提取關鍵信息和重要結論:
+
+{chunks[0]}
+
+請用2-3個段落總結,每個段落不超過100字。"""
+            self._report("正在生成最終總結", 0, 1)
+            self._enqueue(prompt, self._finished)
+            return
+        
+        results = [None] * len(chunks)
+        remaining = [len(chunks)]
+        stage = f"第{level}層: 正在總結各部分"
+        
+        def mapped(index, text):
+            results[index] = text
+            remaining[0] -= 1
+            self._report(stage, len(chunks) - remaining[0], len(chunks))
+            if remaining[0] == 0:
+                partials = [f"第{i + 1}部分摘要:\n{result}" for i, result in enumerate(results)]
+                self._level(partials, level + 1, partial=True)
+        
+        self._report(stage, 0, len(chunks))
+        for index, chunk in enumerate(chunks):
+            prompt = f"""以下是一段較長{self.kind}的第{index + 1}/{len(chunks)}部分,請提取這部分的關鍵信息和重要結論,簡潔地列出:
+
+{chunk}"""
+            self._enqueue(prompt, lambda text, index=index: mapped(index, text))
+    
+    def _finished(self, summary):
+        self._report("完成", 1, 1)
+        self.on_done(summary)
+    
+    def _enqueue(self, prompt, on_success):
+        self._queue.append((prompt, on_success))
+        self._pump()
+    
+    def _pump(self):
+        """保持最多MAX_PARALLEL個請求同時進行"""
+        while self._queue and len(self._in_flight) < self.MAX_PARALLEL and not self.cancelled:
+            prompt, on_success = self._queue.pop(0)
+            key = object()
+            
+            def succeeded(text, key=key, on_success=on_success):
+                self._in_flight.pop(key, None)
+                if not self.cancelled and not self._failed:
+                    on_success(text)
+                    self._pump()
+            
+            def failed(error, key=key):
+                self._in_flight.pop(key, None)
+                if not self._failed and not self.cancelled:
+                    self._failed = True
+                    self._queue.clear()
+                    for token in list(self._in_flight.values()):
+                        token.cancel()
+                    if self.on_error:
+                        self.on_error(error)
+            
+            self._in_flight[key] = self.engine.submit(
+                lambda token, prompt=prompt: self.summarize(prompt, token),
+                on_success=succeeded, on_error=failed, on_cancel=failed
+            )
+    
+    def _report(self, stage, done, total):
+        if self.on_progress:
+            self.on_progress(stage, done, total)
+
+
+class ResponseCache:
+    """本地響應緩存: 相同請求(模型、System、消息、max_tokens)直接返回上次的響應
+    
+    存放在單個SQLite文件中,條目超過TTL失效,總大小超出上限時按最近使用時間淘汰。
+    """
+    
+    TTL = 7 * 24 * 3600
+    MAX_BYTES = 50 * 1024 * 1024
+    
+    def __init__(self, db_file="claude_chat_responses.db"):
+        self.db_file = Path(db_file)
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+    
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(str(self.db_file), check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        return self._conn
+    
+    @staticmethod
+    def make_key(data):
+        """請求內容的哈希(不含cache_control和流式參數)"""
+        payload = {
+            'model': data.get('model'),
+            'system': PromptCachePlanner.canonical(data.get('system', [])),
+            'messages': PromptCachePlanner.canonical(data.get('messages', [])),
+            'max_tokens': data.get('max_tokens')
+        }
+        encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+    
+    def get(self, key):
+        """返回緩存的響應文本,沒有或已過期時返回None"""
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                row = conn.execute("SELECT response FROM responses WHERE key = ? AND created > ?",
+                                   (key, now - self.TTL)).fetchone()
+                if row:
+                    conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    conn.commit()
+            except sqlite3.Error as e:
+                print(f"讀取響應緩存失敗: {e}")
+                row = None
+            if row:
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+    
+    def put(self, key, response_text):
+        """保存響應,並淘汰過期和超出大小上限的條目"""
+        now = time.time()
+        size = len(response_text.encode('utf-8'))
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                             (key, response_text, size, now, now))
+                conn.execute("DELETE FROM responses WHERE created <= ?", (now - self.TTL,))
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.MAX_BYTES:
+                    # 從最久未使用的開始刪除,直到總大小回到上限以內
+                    excess = total - self.MAX_BYTES
+                    removed = []
+                    for entry_key, entry_size in conn.execute(
+                            "SELECT key, size FROM responses ORDER BY accessed"):
+                        if excess <= 0:
+                            break
+                        removed.append((entry_key,))
+                        excess -= entry_size
+                    conn.executemany("DELETE FROM responses WHERE key = ?", removed)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"寫入響應緩存失敗: {e}")
+
+
+class ConversationStore:
+    """追加寫入的對話存儲: 每個會話一個JSONL日誌和一個定長偏移索引
+    
+    - 每條消息添加時立即追加一行,不重寫已有內容
+    - 索引文件每條消息8字節(日誌中的偏移),按索引直接定位最近N條,恢復大會話不必讀完整個日誌
+    - 響應可能在後發送的消息之後才寫入,記錄reply_to,加載時放回對應的用戶消息之後
+    """
+    
+    OFFSET = struct.Struct('<Q')
+    RESUME_MESSAGES = 200  # 恢復會話時加載的最近消息數
+    
+    def __init__(self, store_dir="conversations"):
+        self.store_dir = Path(store_dir)
+        self.session_id = None
+        self._lock = threading.Lock()
+    
+    def _paths(self, session_id):
+        return (self.store_dir / f"{session_id}.jsonl",
+                self.store_dir / f"{session_id}.idx")
+    
+    def new_session(self):
+        """開始新會話(第一條消息寫入時才創建文件)"""
+        with self._lock:
+            self.session_id = None
+    
+    def append(self, message, reply_to=None):
+        """追加一條消息,返回它在會話中的序號"""
+        record = {key: value for key, value in message.items() if not key.startswith('_')}
+        if reply_to is not None:
+            record['reply_to'] = reply_to
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        
+        with self._lock:
+            if self.session_id is None:
+                self.store_dir.mkdir(exist_ok=True)
+                self.session_id = datetime.now().strftime('%Y%m%d-%H%M%S-') + os.urandom(2).hex()
+            log_path, index_path = self._paths(self.session_id)
+            with open(log_path, 'ab') as log:
+                offset = log.tell()
+                log.write(line)
+            with open(index_path, 'ab') as index:
+                seq = index.tell() // self.OFFSET.size
+                index.write(self.OFFSET.pack(offset))
+            return seq
+    
+    def message_count(self, session_id):
+        _, index_path = self._paths(session_id)
+        try:
+            return index_path.stat().st_size // self.OFFSET.size
+        except OSError:
+            return 0
+    
+    def list_sessions(self):
+        """返回 [{'id', 'title', 'count', 'updated'}],最近更新的在前"""
+        sessions = []
+        for log_path in self.store_dir.glob("*.jsonl"):
+            session_id = log_path.stem
+            title = ""
+            try:
+                with open(log_path, 'rb') as log:
+                    first = json.loads(log.readline() or b'{}')
+                title = RollingSummarizer.message_text(first) if 'content' in first else ""
+            except (OSError, ValueError) as e:
+                print(f"讀取會話失敗 {log_path}: {e}")
+            sessions.append({
+                'id': session_id,
+                'title': title.strip().splitlines()[0][:40] if title.strip() else "(空會話)",
+                'count': self.message_count(session_id),
+                'updated': datetime.fromtimestamp(log_path.stat().st_mtime)
+            })
+        sessions.sort(key=lambda session: session['updated'], reverse=True)
+        return sessions
+    
+    def load(self, session_id, limit=None):
+        """加載會話最近的limit條消息,之後追加的消息寫入這個會話
+        
+        返回 (消息列表, 未加載的更早消息數)
+        """
+        limit = limit or self.RESUME_MESSAGES
+        log_path, index_path = self._paths(session_id)
+        with self._lock:
+            count = self.message_count(session_id)
+            first = max(0, count - limit)
+            messages = []
+            if count:
+                with open(index_path, 'rb') as index:
+                    index.seek(first * self.OFFSET.size)
+                    offsets = [offset for offset, in self.OFFSET.iter_unpack(
+                        index.read((count - first) * self.OFFSET.size))]
+                with open(log_path, 'rb') as log:
+                    log.seek(offsets[0])
+                    data = log.read()
+                # 只讀索引登記過的記錄: 寫入中途崩潰留下的半行沒有索引項,
+                # 之後追加的記錄也按自己的偏移讀取,不受它影響
+                for seq, offset in enumerate(offsets, first):
+                    start = offset - offsets[0]
+                    end = data.find(b'\n', start)
+                    try:
+                        record = json.loads(data[start:end if end != -1 else len(data)])
+                    except ValueError:
+                        print(f"跳過無法解析的消息 {session_id}#{seq}")
+                        continue
+                    record['_seq'] = seq
+                    messages.append(record)
+            self.session_id = session_id
+        return self._restore_order(messages), first
+    
+    @staticmethod
+    def _restore_order(records):
+        """把帶reply_to的響應放回對應的用戶消息之後"""
+        ordered = []
+        positions = {}
+        for record in records:
+            reply_to = record.pop('reply_to', None)
+            if reply_to in positions:
+                # 放在該用戶消息已有的響應之後
+                position = positions[reply_to] + 1
+                while position < len(ordered) and ordered[position]['role'] == 'assistant':
+                    position += 1
+                ordered.insert(position, record)
+                positions = {message['_seq']: i for i, message in enumerate(ordered)}
+            else:
+                positions[record['_seq']] = len(ordered)
+                ordered.append(record)
+        return ordered
+    
+    def delete(self, session_id):
+        with self._lock:
+            for path in self._paths(session_id):
+                path.unlink(missing_ok=True)
+            if self.session_id == session_id:
+                self.session_id = None
+
+
+class ImageBlobStore:
+    """按SHA-256內容尋址的圖片存儲
+    
+    對話歷史中的圖片只保存引用 {'type': 'image', 'blob': 哈希, 'media_type': 類型},
+    相同的圖片只存一份;base64在發送請求時才生成,最近用過的編碼結果保存在LRU中。
+    """
+    
+    ENCODED_CACHE_CHARS = 32_000_000  # 編碼結果緩存的總字符數上限
+    
+    def __init__(self, store_dir="image_blobs"):
+        self.store_dir = Path(store_dir)
+        self._encoded = OrderedDict()
+        self._encoded_chars = 0
+        self._lock = threading.Lock()
+    
+    def _path(self, digest):
+        return self.store_dir / digest[:2] / digest
+    
+    def put(self, data, media_type):
+        """保存圖片數據(已存在則跳過),返回消息中使用的圖片引用"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{digest}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        return {'type': 'image', 'blob': digest, 'media_type': media_type}
+    
+    def read(self, digest):
+        return self._path(digest).read_bytes()
+    
+    def size(self, digest):
+        return self._path(digest).stat().st_size
+    
+    def encoded(self, digest):
+        """圖片的base64編碼(帶LRU緩存)"""
+        with self._lock:
+            data = self._encoded.get(digest)
+            if data is not None:
+                self._encoded.move_to_end(digest)
+                return data
+        
+        data = base64.b64encode(self.read(digest)).decode('ascii')
+        with self._lock:
+            if digest not in self._encoded:
+                self._encoded[digest] = data
+                self._encoded_chars += len(data)
+                while self._encoded_chars > self.ENCODED_CACHE_CHARS and len(self._encoded) > 1:
+                    _, evicted = self._encoded.popitem(last=False)
+                    self._encoded_chars -= len(evicted)
+        return data
+    
+    def expand_message(self, message):
+        """把消息中的圖片引用換成API需要的base64圖片塊(不修改原消息)"""
+        content = message['content']
+        if isinstance(content, str) or not any('blob' in item for item in content):
+            return message
+        expanded = []
+        for item in content:
+            if 'blob' in item:
+                block = {key: value for key, value in item.items() if key not in ('blob', 'media_type')}
+                block['source'] = {
+                    'type': 'base64',
+                    'media_type': item['media_type'],
+                    'data': self.encoded(item['blob'])
+                }
+                item = block
+            expanded.append(item)
+        return {**message, 'content': expanded}
+
+
+class ImagePreprocessor:
+    """上傳前的圖片預處理: 縮放到模型可用的最大分辨率,去掉元數據,按內容選擇編碼格式
+    
+    - 照片: JPEG;有透明通道的照片: WebP(不支持時PNG)
+    - 截圖、圖表等顏色少的圖片: PNG,保證文字清晰
+    - BMP等API不支持的格式一律重新編碼;動畫GIF保持原樣
+    """
+    
+    MAX_EDGE = 1568  # 超過此長邊的圖片會被模型縮小,上傳更大的只是浪費
+    MAX_PIXELS = 1_150_000
+    JPEG_QUALITY = 85
+    WEBP_QUALITY = 85
+    GRAPHIC_MAX_COLORS = 2048  # 採樣中不同顏色數不超過此值視為截圖/圖表
+    SUPPORTED_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+    
+    @classmethod
+    def process(cls, data, media_type):
+        """返回處理後的 (數據, 媒體類型)"""
+        image = Image.open(BytesIO(data))
+        if getattr(image, 'is_animated', False) and media_type in cls.SUPPORTED_TYPES:
+            return data, media_type
+        
+        has_metadata = any(key in image.info for key in ('exif', 'xmp', 'XML:com.adobe.xmp'))
+        # 先按EXIF方向旋轉,去掉元數據後方向信息就沒了
+        image = ImageOps.exif_transpose(image)
+        
+        width, height = image.size
+        scale = min(1.0, cls.MAX_EDGE / max(width, height), math.sqrt(cls.MAX_PIXELS / (width * height)))
+        if scale < 1.0:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image = image.resize(size, Image.Resampling.LANCZOS)
+        
+        has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        output = BytesIO()
+        if cls._is_graphic(image):
+            if image.mode not in ('1', 'L', 'LA', 'P', 'RGB', 'RGBA'):
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+            image.save(output, 'PNG', optimize=True)
+            result_type = 'image/png'
+        elif has_alpha:
+            if features.check('webp'):
+                image.convert('RGBA').save(output, 'WEBP', quality=cls.WEBP_QUALITY, method=4)
+                result_type = 'image/webp'
+            else:
+                image.convert('RGBA').save(output, 'PNG', optimize=True)
+                result_type = 'image/png'
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=cls.JPEG_QUALITY,
+                                      optimize=True, progressive=True)
+            result_type = 'image/jpeg'
+        result = output.getvalue()
+        
+        # 原圖已經足夠小且可以直接發送時保留原圖
+        if (scale == 1.0 and not has_metadata and media_type in cls.SUPPORTED_TYPES
+                and len(data) <= len(result)):
+            return data, media_type
+        return result, result_type
+    
+    @classmethod
+    def _is_graphic(cls, image):
+        """用最近鄰縮小的採樣統計顏色數,區分截圖/圖表和照片"""
+        sample = image.convert('RGBA').resize((256, 256), Image.Resampling.NEAREST)
+        return sample.getcolors(maxcolors=cls.GRAPHIC_MAX_COLORS) is not None
+
+
+class ThumbnailCache:
+    """圖片預覽縮略圖的磁盤緩存,按文件路徑、修改時間和大小索引
+    
+    load()在工作線程中執行: JPEG用draft模式在解碼時直接按比例縮小,不必解碼整張大圖。
+    """
+    
+    SIZE = (100, 100)
+    
+    def __init__(self, cache_dir="thumbnails"):
+        self.cache_dir = Path(cache_dir)
+    
+    def _cache_path(self, filename, stat):
+        key = f"{Path(filename).resolve()}|{stat.st_mtime_ns}|{stat.st_size}"
+        return self.cache_dir / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.png"
+    
+    def load(self, filename):
+        """返回縮略圖(PIL Image)"""
+        cache_path = self._cache_path(filename, os.stat(filename))
+        if cache_path.exists():
+            try:
+                with Image.open(cache_path) as cached:
+                    cached.load()
+                    return cached.copy()
+            except OSError as e:
+                print(f"讀取縮略圖緩存失敗: {e}")
+        
+        with Image.open(filename) as image:
+            # 只對JPEG有效: 解碼時按1/2、1/4、1/8縮小
+            image.draft('RGB', (self.SIZE[0] * 2, self.SIZE[1] * 2))
+            thumbnail = ImageOps.exif_transpose(image)
+            thumbnail.thumbnail(self.SIZE)
+            if thumbnail.mode not in ('RGB', 'RGBA'):
+                thumbnail = thumbnail.convert('RGBA')
         
-        # 按相關度排序
-        results.sort(key=lambda x: x['relevance'], reverse=True)
-        return results[:max_results]
+        try:
+            self.cache_dir.mkdir(exist_ok=True)
+            tmp_path = cache_path.with_suffix(f".{threading.get_ident()}.tmp")
+            thumbnail.save(tmp_path, 'PNG')
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"保存縮略圖緩存失敗: {e}")
+        return thumbnail
+
+
+class BackgroundRenderer:
+    """聊天區背景圖片的合成與緩存
     
-    def _extract_snippets(self, content, query, num_snippets=2, context_chars=100):
-        """提取包含查詢詞的文本片段"""
-        snippets = []
-        query_lower = query.lower()
-        content_lower = content.lower()
+    - 原圖只解碼一次,縮成長邊不超過MASTER_EDGE的母版,之後都從母版縮放
+    - 合成結果按 (圖片, 尺寸, 透明度, 背景色) 緩存,切換回已有的組合時直接復用
+    - 每個 (圖片, 尺寸, 背景色) 預先算好背景色層和不透明度為1的合成圖,
+      任意透明度o的結果 = 背景色層 + o × (合成圖 - 背景色層),一次Image.blend即可得到
+    - 縮放和合成在單個後台線程中進行,排隊期間被新請求取代的任務直接跳過;
+      結果通過root.after交回主線程,由on_ready創建PhotoImage
+    """
+    
+    MASTER_EDGE = 2560
+    CACHE_SIZE = 4
+    LAYER_CACHE_SIZE = 2
+    RESIZE_DEBOUNCE_MS = 120
+    
+    def __init__(self, root, on_ready):
+        self.root = root
+        self.on_ready = on_ready  # on_ready(PIL圖片),在主線程中調用
+        self._master_key = None
+        self._master = None
+        self._cache = OrderedDict()
+        self._layers = OrderedDict()  # 只在後台線程中訪問
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="background")
+        self._latest = None
+        self._debounce_id = None
+    
+    def request(self, path, size, opacity, bg_rgb, delay_ms=0):
+        """請求渲染背景;delay_ms內的連續請求只執行最後一次"""
+        key = (path, size, round(opacity, 2), bg_rgb)
+        self._latest = key
+        if self._debounce_id is not None:
+            self.root.after_cancel(self._debounce_id)
+            self._debounce_id = None
+        
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        if cached is not None:
+            self.on_ready(cached)
+            return
         
-        start = 0
-        for _ in range(num_snippets):
-            pos = content_lower.find(query_lower, start)
-            if pos == -1:
-                break
-            
-            snippet_start = max(0, pos - context_chars)
-            snippet_end = min(len(content), pos + len(query) + context_chars)
-            snippet = content[snippet_start:snippet_end]
+        if delay_ms:
+            self._debounce_id = self.root.after(delay_ms, self._submit, key)
+        else:
+            self._submit(key)
+    
+    def _submit(self, key):
+        self._debounce_id = None
+        if key == self._latest:
+            self._executor.submit(self._render, key)
+    
+    def _load_master(self, path):
+        """解碼原圖並縮成母版(同一文件只做一次)"""
+        stat = os.stat(path)
+        master_key = (path, stat.st_mtime_ns, stat.st_size)
+        if master_key != self._master_key:
+            with Image.open(path) as image:
+                image.draft('RGB', (self.MASTER_EDGE, self.MASTER_EDGE))
+                master = image.convert('RGBA')
+            master.thumbnail((self.MASTER_EDGE, self.MASTER_EDGE), Image.Resampling.LANCZOS)
+            self._master = master
+            self._master_key = master_key
+            self._layers.clear()
+            with self._lock:
+                self._cache.clear()
+        return self._master
+    
+    def _load_layers(self, path, size, bg_rgb):
+        """返回 (背景色層, 不透明度為1的合成圖),同一尺寸和背景色只計算一次"""
+        master = self._load_master(path)
+        layer_key = (path, size, bg_rgb)
+        layers = self._layers.get(layer_key)
+        if layers is None:
+            # 調整圖片大小以適應窗口
+            image = master.resize(size, Image.Resampling.LANCZOS)
             
-            if snippet_start > 0:
-                snippet = "..." + snippet
-            if snippet_end < len(content):
-                snippet = snippet + "..."
+            # 創建背景色圖層
+            background = Image.new('RGBA', image.size, bg_rgb + (255,))
             
-            snippets.append(snippet)
-            start = pos + len(query)
+            # 按圖片自身的alpha合成,透明度在blend時再乘上
+            full = Image.alpha_composite(background, image).convert('RGB')
+            layers = (background.convert('RGB'), full)
+            self._layers[layer_key] = layers
+            while len(self._layers) > self.LAYER_CACHE_SIZE:
+                self._layers.popitem(last=False)
+        else:
+            self._layers.move_to_end(layer_key)
+        return layers
+    
+    def _render(self, key):
+        """在後台線程中縮放並合成"""
+        if key != self._latest:
+            return
+        path, size, opacity, bg_rgb = key
+        try:
+            background, full = self._load_layers(path, size, bg_rgb)
+            # 線性插值,等價於把圖片alpha乘以opacity後再與背景色合成
+            combined = Image.blend(background, full, opacity)
+        except Exception as e:
+            print(f"應用背景失敗: {e}")
+            return
         
-        return snippets
+        with self._lock:
+            self._cache[key] = combined
+            while len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        self.root.after(0, self._deliver, key, combined)
     
-    def get_all_documents(self):
-        """獲取所有文檔列表"""
-        return list(self.documents.keys())
+    def _deliver(self, key, image):
+        if key == self._latest:
+            self.on_ready(image)
 
 
 class MarkdownRenderer:
     """Markdown渲染器"""
     
     @staticmethod
-    def render_to_text_widget(text_widget, markdown_text, tags_config):
-        """將Markdown文本渲染到Text Widget"""
+    def render_to_text_widget(text_widget, markdown_text, tags_config, index=tk.END):
+        """將Markdown文本渲染到Text Widget(index為插入位置,可以是向右移動的標記)"""
         lines = markdown_text.split('\n')
         i = 0
         
@@ -159,49 +2511,124 @@ class MarkdownRenderer:
                     i += 1
                 
                 code_text = '\n'.join(code_lines)
-                text_widget.insert(tk.END, code_text + '\n', 'code')
+                text_widget.insert(index, code_text + '\n', 'code')
                 i += 1
                 continue
             
-            # 標題
-            if line.startswith('###'):
-                text_widget.insert(tk.END, line[3:].strip() + '\n', 'h3')
-            elif line.startswith('##'):
-                text_widget.insert(tk.END, line[2:].strip() + '\n', 'h2')
-            elif line.startswith('#'):
-                text_widget.insert(tk.END, line[1:].strip() + '\n', 'h1')
-            # 列表
-            elif line.strip().startswith('- ') or line.strip().startswith('* '):
-                text_widget.insert(tk.END, '  • ' + line.strip()[2:] + '\n', 'list')
-            elif re.match(r'^\d+\.', line.strip()):
-                text_widget.insert(tk.END, line + '\n', 'list')
-            # 行內樣式
-            else:
-                MarkdownRenderer._render_inline(text_widget, line + '\n', tags_config)
-            
+            MarkdownRenderer._render_line(text_widget, line, tags_config, index=index)
             i += 1
     
     @staticmethod
-    def _render_inline(text_widget, line, tags_config):
+    def _render_line(text_widget, line, tags_config, end='\n', index=tk.END):
+        """渲染代碼塊之外的一行"""
+        # 標題
+        if line.startswith('###'):
+            text_widget.insert(index, line[3:].strip() + end, 'h3')
+        elif line.startswith('##'):
+            text_widget.insert(index, line[2:].strip() + end, 'h2')
+        elif line.startswith('#'):
+            text_widget.insert(index, line[1:].strip() + end, 'h1')
+        # 列表
+        elif line.strip().startswith('- ') or line.strip().startswith('* '):
+            text_widget.insert(index, '  • ' + line.strip()[2:] + end, 'list')
+        elif re.match(r'^\d+\.', line.strip()):
+            text_widget.insert(index, line + end, 'list')
+        # 行內樣式
+        else:
+            MarkdownRenderer._render_inline(text_widget, line + end, tags_config, index)
+    
+    @staticmethod
+    def _render_inline(text_widget, line, tags_config, index=tk.END):
         """處理行內Markdown樣式"""
         # 處理加粗 **text**
         parts = re.split(r'(\*\*.*?\*\*)', line)
         for part in parts:
             if part.startswith('**') and part.endswith('**'):
-                text_widget.insert(tk.END, part[2:-2], 'bold')
+                text_widget.insert(index, part[2:-2], 'bold')
             # 處理斜體 *text*
             elif part.startswith('*') and part.endswith('*') and not part.startswith('**'):
-                text_widget.insert(tk.END, part[1:-1], 'italic')
+                text_widget.insert(index, part[1:-1], 'italic')
             # 處理行內代碼 `code`
             elif '`' in part:
                 code_parts = part.split('`')
                 for j, code_part in enumerate(code_parts):
                     if j % 2 == 1:  # 奇數索引是代碼
-                        text_widget.insert(tk.END, code_part, 'inline_code')
+                        text_widget.insert(index, code_part, 'inline_code')
                     else:
-                        text_widget.insert(tk.END, code_part)
+                        text_widget.insert(index, code_part)
             else:
-                text_widget.insert(tk.END, part)
+                text_widget.insert(index, part)
+
+
+class StreamingMarkdownRenderer:
+    """增量Markdown渲染器: 逐塊接收流式文本,邊接收邊渲染
+    
+    已完成的行按MarkdownRenderer的規則渲染一次後不再改動,代碼塊的開閉狀態跨塊保持;
+    每次只刪除並重新渲染未完成的最後一行(標題、列表、加粗等樣式在行內確定)。
+    總渲染量與響應長度成線性關係,不必在結束時整條重新渲染。
+    index是插入位置: 默認為末尾,也可以是向右移動的標記,之後插入在它後面的內容不受影響。
+    """
+    
+    TAIL_MARK = 'md_tail'
+    TAIL_RERENDER_LIMIT = 4096  # 未完成的行超過此長度時先按純文本追加,整行完成後再渲染
+    
+    def __init__(self, text_widget, tags_config=None, index=tk.END):
+        self.text_widget = text_widget
+        self.tags_config = tags_config
+        self.index = index
+        self.in_code = False
+        self.tail = ""
+        # 標記未完成行的起點,新內容插入在它之後
+        self._tail_start = 'end-1c' if index == tk.END else index
+        text_widget.mark_set(self.TAIL_MARK, self._tail_start)
+        text_widget.mark_gravity(self.TAIL_MARK, tk.LEFT)
+    
+    def feed(self, chunk):
+        """追加一塊文本"""
+        if not chunk:
+            return
+        lines = (self.tail + chunk).split('\n')
+        previous_tail = self.tail
+        self.tail = lines.pop()
+        
+        if not lines and len(previous_tail) >= self.TAIL_RERENDER_LIMIT:
+            self.text_widget.insert(self.index, chunk, 'code' if self.in_code else ())
+            return
+        
+        self.text_widget.delete(self.TAIL_MARK, self.index)
+        if lines:
+            for line in lines:
+                self._render_complete_line(line)
+            self.text_widget.mark_set(self.TAIL_MARK, self._tail_start)
+        self._render_tail()
+    
+    def finish(self):
+        """流結束: 把最後一行按完整的行渲染"""
+        self.text_widget.delete(self.TAIL_MARK, self.index)
+        self._render_complete_line(self.tail)
+        self.tail = ""
+        self.text_widget.mark_unset(self.TAIL_MARK)
+    
+    def _render_complete_line(self, line):
+        # 代碼塊的開始和結束行本身不顯示
+        if line.strip().startswith('```'):
+            self.in_code = not self.in_code
+        elif self.in_code:
+            self.text_widget.insert(self.index, line + '\n', 'code')
+        else:
+            MarkdownRenderer._render_line(self.text_widget, line, self.tags_config, index=self.index)
+    
+    def _render_tail(self):
+        """臨時渲染未完成的行"""
+        if not self.tail:
+            return
+        if self.tail.strip().startswith('```'):
+            self.text_widget.insert(self.index, self.tail)
+        elif self.in_code:
+            self.text_widget.insert(self.index, self.tail, 'code')
+        else:
+            MarkdownRenderer._render_line(self.text_widget, self.tail, self.tags_config, end='',
+                                          index=self.index)
 
 
 class ClaudeChatUltimate:
@@ -279,18 +2706,70 @@ class ClaudeChatUltimate:
         self.total_output_tokens = 0
         self.total_cache_creation_tokens = 0
         self.total_cache_read_tokens = 0
+        self.last_ttft = None  # 最近一次流式響應的首字延遲(秒)
         
-        # 知識庫
-        self.kb = KnowledgeBase()
+        # 流式輸出
+        self.stream_responses = True
+        self._stream_renderer = None
+        self._reply_marks = 0  # 已創建的回復位置標記數,用於生成標記名
         
         # 用戶設置
         self.user_name = "User"
         self.ai_name = "Claude"
         
+        # 知識庫設置
+        self.kb_search_mode = 'keyword'
+        self.kb_lazy_loading = True
+        self.kb_watch_enabled = True
+        
+        # 對話超長時在後台自動更新滾動摘要
+        self.auto_summary = True
+        
+        # 網絡設置
+        self.response_cache_enabled = False
+        self.http_warm_up = True
+        self.api_rate_limit = 60  # 每分鐘最多請求數
+        
+        # 上下文設置
+        self.context_budget = ContextWindowManager.DEFAULT_BUDGET
+        
         # 加載配置
         self.config_file = Path("claude_chat_config.json")
         self.load_config()
         
+        # 共享的HTTP客戶端,所有API請求復用連接池
+        self.api_client = APIClient()
+        if self.http_warm_up and self.api_key:
+            self.api_client.warm_up()
+        self.scheduler = RequestScheduler(self.api_client, self.api_rate_limit)
+        self.engine = AsyncRequestEngine(self.root)
+        self.scheduler.on_change = lambda: self.root.after(0, self.update_stats)
+        self.engine.on_change = self.update_stats
+        self.context_manager = ContextWindowManager(self.context_budget)
+        self.cache_planner = PromptCachePlanner()
+        self.response_cache = ResponseCache()
+        self.rolling_summarizer = RollingSummarizer()
+        self.conversation_store = ConversationStore()
+        self.image_store = ImageBlobStore()
+        self.image_executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1),
+                                                 thread_name_prefix="image")
+        self.pending_images = 0
+        self.image_batch = 0  # 清除圖片時遞增,仍在處理中的舊批次完成後直接丟棄
+        self.image_bytes_saved = 0
+        self.thumbnail_cache = ThumbnailCache()
+        self.background_renderer = BackgroundRenderer(self.root, self._show_background)
+        
+        # 知識庫(懶加載時只讀取文件元數據)
+        # 新增或修改的文件在後台攝取,完成後刷新文檔列表
+        self.kb = KnowledgeBase(lazy=self.kb_lazy_loading,
+                                on_documents_changed=lambda: self.root.after(0, self.refresh_kb_list))
+        self.kb.search_mode = self.kb_search_mode
+        
+        # 監視知識庫目錄,文件變化後自動更新索引
+        self.kb_watcher = KnowledgeBaseWatcher(self.kb)
+        if self.kb_watch_enabled:
+            self.kb_watcher.start()
+        
         # 創建界面
         self.setup_ui()
         
@@ -399,10 +2878,38 @@ class ClaudeChatUltimate:
         if self.system_prompt:
             self.system_text.insert("1.0", self.system_prompt)
         
+        # 上下文預算
+        budget_row = ttk.Frame(parent)
+        budget_row.pack(fill=tk.X, pady=5, padx=5)
+        ttk.Label(budget_row, text="上下文預算 (tokens):").pack(side=tk.LEFT)
+        self.context_budget_var = tk.StringVar(value=str(self.context_budget))
+        ttk.Spinbox(budget_row, from_=4000, to=200000, increment=4000, width=10,
+                    textvariable=self.context_budget_var).pack(side=tk.LEFT, padx=5)
+        
+        # 流式輸出
+        self.stream_var = tk.BooleanVar(value=self.stream_responses)
+        ttk.Checkbutton(parent, text="流式輸出響應", variable=self.stream_var,
+                        command=self.toggle_streaming).pack(pady=5, padx=5, anchor=tk.W)
+        
+        # 本地響應緩存
+        self.response_cache_var = tk.BooleanVar(value=self.response_cache_enabled)
+        ttk.Checkbutton(parent, text="本地緩存相同請求的響應", variable=self.response_cache_var,
+                        command=self.toggle_response_cache).pack(pady=5, padx=5, anchor=tk.W)
+        
         # 保存按鈕
         ttk.Button(parent, text="💾 保存配置", 
                   command=self.save_config).pack(pady=10)
         
+    def toggle_streaming(self):
+        """切換流式輸出"""
+        self.stream_responses = self.stream_var.get()
+        self.save_config()
+        
+    def toggle_response_cache(self):
+        """切換本地響應緩存"""
+        self.response_cache_enabled = self.response_cache_var.get()
+        self.save_config()
+        
     def create_kb_panel(self, parent):
         """創建知識庫面板"""
         # 文檔列表
@@ -429,7 +2936,19 @@ class ClaudeChatUltimate:
         ttk.Button(button_frame, text="🔍 測試搜索", 
                   command=self.test_kb_search).pack(side=tk.LEFT, padx=2)
         ttk.Button(button_frame, text="🔄 刷新", 
-                  command=self.refresh_kb_list).pack(side=tk.LEFT, padx=2)
+                  command=self.rescan_kb).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_frame, text="📝 總結文檔", 
+                  command=self.summarize_kb_document).pack(side=tk.LEFT, padx=2)
+        
+        # 搜索模式選擇
+        mode_frame = ttk.Frame(parent)
+        mode_frame.pack(fill=tk.X, pady=5, padx=5)
+        ttk.Label(mode_frame, text="搜索模式:").pack(side=tk.LEFT)
+        mode_combo = ttk.Combobox(mode_frame, values=list(KnowledgeBase.SEARCH_MODES),
+                                  state='readonly', width=10)
+        mode_combo.set(self.kb.search_mode)
+        mode_combo.bind('<<ComboboxSelected>>', self.change_kb_search_mode)
+        mode_combo.pack(side=tk.LEFT, padx=5)
         
     def create_customization_panel(self, parent):
         """創建個性化設置面板"""
@@ -493,9 +3012,9 @@ class ClaudeChatUltimate:
         # 綁定resize事件以調整Text widget大小
         def on_canvas_resize(event):
             self.bg_canvas.itemconfig(self.canvas_window, width=event.width, height=event.height)
-            # 同時重新應用背景
+            # 同時重新應用背景(拖動窗口邊框時只在停下後渲染一次)
             if hasattr(self, 'background_image_path') and self.background_image_path:
-                self.root.after(10, self._apply_background)
+                self._apply_background(delay_ms=BackgroundRenderer.RESIZE_DEBOUNCE_MS)
         
         self.bg_canvas.bind('<Configure>', on_canvas_resize)
         
@@ -522,15 +3041,21 @@ class ClaudeChatUltimate:
                   command=self.clear_images).pack(side=tk.LEFT, padx=2)
         ttk.Button(button_row, text="🔄 清空對話", 
                   command=self.clear_conversation).pack(side=tk.LEFT, padx=2)
+        ttk.Button(button_row, text="📂 歷史會話", 
+                  command=self.show_sessions).pack(side=tk.LEFT, padx=2)
         
         # 輸入框
         self.input_text = scrolledtext.ScrolledText(input_frame, height=4, wrap=tk.WORD)
         self.input_text.pack(fill=tk.BOTH, expand=True, pady=5)
         self.input_text.bind('<Control-Return>', lambda e: self.send_message())
         
-        # 發送按鈕
-        ttk.Button(input_frame, text="🚀 發送 (Ctrl+Enter)", 
-                  command=self.send_message).pack(fill=tk.X)
+        # 發送/停止按鈕
+        send_row = ttk.Frame(input_frame)
+        send_row.pack(fill=tk.X)
+        ttk.Button(send_row, text="⏹ 停止", 
+                  command=self.stop_generation).pack(side=tk.RIGHT, padx=(5, 0))
+        ttk.Button(send_row, text="🚀 發送 (Ctrl+Enter)", 
+                  command=self.send_message).pack(side=tk.LEFT, fill=tk.X, expand=True)
         
         # 統計信息
         self.stats_label = ttk.Label(main_container, text="等待發送消息...")
@@ -630,8 +3155,8 @@ class ClaudeChatUltimate:
             except Exception as e:
                 messagebox.showerror("錯誤", f"設置背景失敗: {e}")
     
-    def _apply_background(self):
-        """應用背景圖片和透明度"""
+    def _apply_background(self, delay_ms=0):
+        """應用背景圖片和透明度(在後台渲染,完成後由_show_background顯示)"""
         if not hasattr(self, 'background_image_path') or not self.background_image_path:
             return
         
@@ -641,46 +3166,29 @@ class ClaudeChatUltimate:
         if not hasattr(self, 'bg_canvas'):
             return
         
+        # 獲取Canvas的尺寸
+        width = self.bg_canvas.winfo_width()
+        height = self.bg_canvas.winfo_height()
+        
+        # 如果尺寸太小(窗口還未完全初始化),使用默認值
+        if width < 100 or height < 100:
+            width = 800
+            height = 600
+        
+        # 獲取當前主題的背景色
+        theme = self.THEMES[self.current_theme]
+        bg_color = theme['chat_bg']
+        
+        # 轉換十六進制顏色為RGB
+        bg_rgb = tuple(int(bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
+        
+        self.background_renderer.request(self.background_image_path, (width, height),
+                                         self.background_opacity, bg_rgb, delay_ms)
+        
+    def _show_background(self, combined):
+        """在Canvas上顯示合成好的背景"""
         try:
-            # 加載圖片
-            image = Image.open(self.background_image_path)
-            
-            # 獲取Canvas的尺寸
-            width = self.bg_canvas.winfo_width()
-            height = self.bg_canvas.winfo_height()
-            
-            # 如果尺寸太小(窗口還未完全初始化),使用默認值
-            if width < 100 or height < 100:
-                width = 800
-                height = 600
-            
-            # 調整圖片大小以適應窗口
-            image = image.resize((width, height), Image.Resampling.LANCZOS)
-            
-            # 創建半透明效果
-            if image.mode != 'RGBA':
-                image = image.convert('RGBA')
-            
-            # 獲取當前主題的背景色
             theme = self.THEMES[self.current_theme]
-            bg_color = theme['chat_bg']
-            
-            # 轉換十六進制顏色為RGB
-            bg_rgb = tuple(int(bg_color.lstrip('#')[i:i+2], 16) for i in (0, 2, 4))
-            
-            # 創建背景色圖層
-            background = Image.new('RGBA', image.size, bg_rgb + (255,))
-            
-            # 調整圖片透明度
-            alpha = image.split()[3]
-            alpha = ImageEnhance.Brightness(alpha).enhance(self.background_opacity)
-            image.putalpha(alpha)
-            
-            # 合成圖片
-            combined = Image.alpha_composite(background, image)
-            
-            # 轉換為RGB
-            combined = combined.convert('RGB')
             
             # 保存為PhotoImage
             self.background_photo = ImageTk.PhotoImage(combined)
@@ -870,7 +3378,7 @@ class ClaudeChatUltimate:
         data = {
             'export_time': datetime.now().isoformat(),
             'system_prompt': self.system_text.get("1.0", tk.END).strip(),
-            'conversation': self.conversation_history,
+            'conversation': [ContextWindowManager.strip_private(m) for m in self.conversation_history],
             'statistics': {
                 'total_input_tokens': self.total_input_tokens,
                 'total_output_tokens': self.total_output_tokens,
@@ -893,38 +3401,157 @@ class ClaudeChatUltimate:
             messagebox.showwarning("提示", "請先設置API Key")
             return
         
-        # 構建總結請求
-        conversation_text = ""
-        for msg in self.conversation_history:
-            role = msg['role']
-            content = msg['content']
-            if isinstance(content, str):
-                conversation_text += f"{role}: {content}\n\n"
+        if self.rolling_summarizer.running:
+            messagebox.showinfo("提示", "正在後台更新摘要,請稍候再試")
+            return
         
-        summary_prompt = f"""請簡潔地總結以下對話的核心內容,提取關鍵信息和重要結論:
-
-{conversation_text}
-
-請用2-3個段落總結,每個段落不超過50字。"""
+        progress = self.open_progress_window("正在生成總結")
         
-        # 在新線程中執行總結
-        def do_summarize():
-            try:
-                response = self.call_claude_api(summary_prompt, use_cache=False)
-                
-                # 顯示總結
-                self.root.after(0, lambda: self.show_summary(response))
-            except Exception as e:
-                self.root.after(0, lambda: messagebox.showerror("錯誤", f"總結失敗: {e}"))
+        def done(summary):
+            progress.close()
+            self.show_summary(summary)
+        
+        def failed(error):
+            progress.close()
+            messagebox.showerror("錯誤", f"總結失敗: {error}")
+        
+        # 只把上次摘要之後的新消息合併進滾動摘要
+        request = self.run_rolling_summary(include_recent=True, on_done=done, on_error=failed,
+                                           on_progress=progress.update)
+        if request is None:
+            progress.close()
+        else:
+            progress.on_cancel = request.cancel
+        
+    def summarize_kb_document(self):
+        """用map-reduce總結知識庫中選中的文檔"""
+        selection = self.kb_listbox.curselection()
+        if not selection:
+            messagebox.showwarning("提示", "請先在列表中選擇一個文檔")
+            return
+        
+        if not self.api_key:
+            messagebox.showwarning("提示", "請先設置API Key")
+            return
+        
+        doc_name = self.kb_listbox.get(selection[0])
+        content = self.kb.get_document_content(doc_name)
+        if not content or not content.strip():
+            messagebox.showwarning("提示", "文檔內容為空")
+            return
         
-        threading.Thread(target=do_summarize, daemon=True).start()
-        messagebox.showinfo("提示", "正在生成總結,請稍候...")
+        progress = self.open_progress_window(f"正在總結: {doc_name}")
+        summarizer = MapReduceSummarizer(self.engine, self._summarize_prompt, progress.update)
+        progress.on_cancel = summarizer.cancel
+        
+        def done(summary):
+            progress.close()
+            self.show_summary(summary, title=f"文檔總結: {doc_name}", replaceable=False)
+        
+        def failed(error):
+            progress.close()
+            messagebox.showerror("錯誤", f"總結失敗: {error}")
+        
+        summarizer.run(MapReduceSummarizer.split_units(content), f"文檔《{doc_name}》", done, failed)
+        
+    def _summarize_prompt(self, prompt, token=None):
+        """發送單條總結請求(在工作線程中執行)"""
+        return self.call_claude_api(prompt, use_cache=False, token=token)
+        
+    def open_progress_window(self, title):
+        """打開總結進度窗口,返回帶update(說明, 已完成, 總數)和close()的對象"""
+        window = tk.Toplevel(self.root)
+        window.title(title)
+        window.geometry("360x130")
+        window.transient(self.root)
+        
+        label = ttk.Label(window, text="準備中...")
+        label.pack(pady=(15, 5), padx=10, anchor=tk.W)
+        bar = ttk.Progressbar(window, mode='determinate', maximum=1)
+        bar.pack(fill=tk.X, padx=10)
+        
+        class Progress:
+            on_cancel = None
+            
+            @staticmethod
+            def update(stage, done, total):
+                if window.winfo_exists():
+                    label.config(text=f"{stage} ({done}/{total})")
+                    bar.config(maximum=max(total, 1), value=done)
+            
+            @staticmethod
+            def close():
+                if window.winfo_exists():
+                    window.destroy()
+        
+        def cancel():
+            if Progress.on_cancel:
+                Progress.on_cancel()
+            Progress.close()
+        
+        ttk.Button(window, text="取消", command=cancel).pack(pady=10)
+        window.protocol("WM_DELETE_WINDOW", cancel)
+        return Progress
+        
+    def maybe_roll_summary(self):
+        """未摘要的內容超過閾值時在後台更新滾動摘要"""
+        if not self.auto_summary or self.rolling_summarizer.running:
+            return
+        if self.rolling_summarizer.pending_tokens(self.conversation_history) >= RollingSummarizer.TRIGGER_TOKENS:
+            self.run_rolling_summary()
+        
+    def run_rolling_summary(self, include_recent=False, on_done=None, on_error=None, on_progress=None):
+        """把水位線之後的消息合併進滾動摘要,沒有新內容時直接返回當前摘要
+        
+        返回可以cancel()的請求對象,沒有提交請求時返回None
+        """
+        summarizer = self.rolling_summarizer
+        new_messages, summary_prompt = summarizer.prepare(self.conversation_history, include_recent)
+        if not new_messages:
+            if on_done:
+                on_done(summarizer.summary)
+            return None
+        
+        summarizer.running = True
+        
+        def finished(summary):
+            summarizer.running = False
+            summarizer.commit(self.conversation_history, new_messages, summary)
+            if on_done:
+                on_done(summarizer.summary)
+        
+        def failed(error):
+            summarizer.running = False
+            if on_error:
+                on_error(error)
+            else:
+                print(f"更新滾動摘要失敗: {error}")
+        
+        def cancelled(error):
+            summarizer.running = False
+        
+        # 新內容超出單次請求的容量時分塊map-reduce
+        if ContextWindowManager.estimate_text(summary_prompt) > MapReduceSummarizer.CHUNK_TOKENS:
+            map_reduce = MapReduceSummarizer(self.engine, self._summarize_prompt, on_progress)
+            map_reduce.run(summarizer.fold_units(new_messages), "對話", finished, failed, cancelled)
+            return map_reduce
+        
+        # 交給請求引擎在後台執行
+        if on_progress:
+            on_progress("正在生成總結", 0, 1)
+        return self.engine.submit(
+            lambda token: self._summarize_prompt(summary_prompt, token),
+            on_success=finished,
+            on_error=failed,
+            on_cancel=cancelled,
+            channel="summary"
+        )
         
-    def show_summary(self, summary):
+    def show_summary(self, summary, title="對話總結", replaceable=True):
         """顯示總結結果"""
         # 創建總結窗口
         summary_window = tk.Toplevel(self.root)
-        summary_window.title("對話總結")
+        summary_window.title(title)
         summary_window.geometry("600x400")
         
         # 總結文本
@@ -940,22 +3567,26 @@ class ClaudeChatUltimate:
         def replace_history():
             """用總結替換對話歷史"""
             if messagebox.askyesno("確認", "是否用總結替換當前對話歷史?這將清除原有對話但保留總結內容。"):
-                self.conversation_history = [
-                    {
-                        'role': 'user',
-                        'content': '請總結我們之前的對話'
-                    },
-                    {
-                        'role': 'assistant',
-                        'content': summary
-                    }
-                ]
+                self.engine.cancel_channel("chat")
+                self.conversation_history = []
+                self.conversation_store.new_session()
+                self._append_history({
+                    'role': 'user',
+                    'content': '請總結我們之前的對話'
+                })
+                self._append_history({
+                    'role': 'assistant',
+                    'content': summary
+                })
+                self.context_manager.reset()
+                self.rolling_summarizer.reset()
                 self.refresh_chat_display()
                 summary_window.destroy()
                 messagebox.showinfo("成功", "已用總結替換對話歷史")
         
-        ttk.Button(button_frame, text="✅ 用總結替換歷史", 
-                  command=replace_history).pack(side=tk.LEFT, padx=5)
+        if replaceable:
+            ttk.Button(button_frame, text="✅ 用總結替換歷史", 
+                      command=replace_history).pack(side=tk.LEFT, padx=5)
         ttk.Button(button_frame, text="❌ 關閉", 
                   command=summary_window.destroy).pack(side=tk.RIGHT, padx=5)
         
@@ -970,37 +3601,59 @@ class ClaudeChatUltimate:
             filetypes=[("圖片文件", "*.png *.jpg *.jpeg *.gif *.bmp *.webp")]
         )
         
-        for filename in filenames:
-            try:
-                # 讀取並轉換圖片
-                with open(filename, 'rb') as f:
-                    image_data = base64.b64encode(f.read()).decode('utf-8')
-                
-                # 檢測圖片類型
-                ext = Path(filename).suffix.lower()
-                media_type = {
-                    '.png': 'image/png',
-                    '.jpg': 'image/jpeg',
-                    '.jpeg': 'image/jpeg',
-                    '.gif': 'image/gif',
-                    '.bmp': 'image/bmp',
-                    '.webp': 'image/webp'
-                }.get(ext, 'image/jpeg')
-                
-                self.uploaded_images.append({
-                    'type': 'image',
-                    'source': {
-                        'type': 'base64',
-                        'media_type': media_type,
-                        'data': image_data
-                    }
-                })
+        # 預覽縮略圖和預處理都在線程池中進行,按選擇順序添加
+        previews = [self.show_image_preview(filename) for filename in filenames]
+        futures = [self.image_executor.submit(self.prepare_image, filename) for filename in filenames]
+        self.pending_images += len(futures)
+        batch = self.image_batch
+        
+        def add_ready(start=0):
+            """依次添加已完成的圖片,遇到未完成的稍後再檢查"""
+            for index in range(start, len(futures)):
+                if self.image_batch != batch:
+                    return  # 圖片已被清除
+                if not futures[index].done():
+                    self.root.after(50, add_ready, index)
+                    return
+                self.pending_images -= 1
+                filename = filenames[index]
+                try:
+                    image_ref, original_size = futures[index].result()
+                except Exception as e:
+                    previews[index].destroy()
+                    messagebox.showerror("錯誤", f"讀取圖片失敗 {Path(filename).name}: {e}")
+                    continue
                 
-                # 顯示預覽
-                self.show_image_preview(filename)
+                self.uploaded_images.append(image_ref)
+                self.image_bytes_saved += original_size - self.image_store.size(image_ref['blob'])
+            self.update_stats()
+        
+        if futures:
+            add_ready()
                 
-            except Exception as e:
-                messagebox.showerror("錯誤", f"讀取圖片失敗: {e}")
+    def prepare_image(self, filename):
+        """讀取並預處理圖片,存入內容尋址存儲(在線程池中執行)
+        
+        返回 (圖片引用, 原始字節數)
+        """
+        with open(filename, 'rb') as f:
+            image_data = f.read()
+        
+        # 檢測圖片類型
+        ext = Path(filename).suffix.lower()
+        media_type = {
+            '.png': 'image/png',
+            '.jpg': 'image/jpeg',
+            '.jpeg': 'image/jpeg',
+            '.gif': 'image/gif',
+            '.bmp': 'image/bmp',
+            '.webp': 'image/webp'
+        }.get(ext, 'image/jpeg')
+        
+        processed, media_type = ImagePreprocessor.process(image_data, media_type)
+        
+        # 圖片存入內容尋址存儲,消息中只保存引用
+        return self.image_store.put(processed, media_type), len(image_data)
                 
     def upload_document(self):
         """上傳文檔(PDF或Word)"""
@@ -1077,32 +3730,42 @@ class ClaudeChatUltimate:
             return None
             
     def show_image_preview(self, filename):
-        """顯示圖片預覽"""
-        try:
-            # 創建預覽標籤
-            preview = ttk.Frame(self.image_preview_frame)
-            preview.pack(side=tk.LEFT, padx=5)
-            
-            # 加載並縮放圖片
-            img = Image.open(filename)
-            img.thumbnail((100, 100))
-            photo = ImageTk.PhotoImage(img)
-            
-            label = ttk.Label(preview, image=photo)
-            label.image = photo  # 保持引用
-            label.pack()
-            
-            # 文件名
-            name = Path(filename).name
-            if len(name) > 15:
-                name = name[:12] + "..."
-            ttk.Label(preview, text=name).pack()
-            
-        except Exception as e:
-            print(f"顯示預覽失敗: {e}")
+        """顯示圖片預覽: 先放佔位,縮略圖在後台生成後再填入,返回預覽框"""
+        # 創建預覽標籤
+        preview = ttk.Frame(self.image_preview_frame)
+        preview.pack(side=tk.LEFT, padx=5)
+        
+        label = ttk.Label(preview, text="載入中...")
+        label.pack()
+        
+        # 文件名
+        name = Path(filename).name
+        if len(name) > 15:
+            name = name[:12] + "..."
+        ttk.Label(preview, text=name).pack()
+        
+        def load_thumbnail():
+            try:
+                thumbnail = self.thumbnail_cache.load(filename)
+            except Exception as e:
+                print(f"顯示預覽失敗: {e}")
+                return
+            self.root.after(0, set_thumbnail, thumbnail)
+        
+        def set_thumbnail(thumbnail):
+            # PhotoImage必須在主線程中創建
+            if label.winfo_exists():
+                photo = ImageTk.PhotoImage(thumbnail)
+                label.config(image=photo, text="")
+                label.image = photo  # 保持引用
+        
+        self.image_executor.submit(load_thumbnail)
+        return preview
             
     def clear_images(self):
-        """清除已上傳的圖片"""
+        """清除已上傳的圖片(包括仍在處理中的)"""
+        self.image_batch += 1
+        self.pending_images = 0
         self.uploaded_images.clear()
         for widget in self.image_preview_frame.winfo_children():
             widget.destroy()
@@ -1156,6 +3819,7 @@ class ClaudeChatUltimate:
             return
         
         results = self.kb.search(query)
+        self.update_stats()
         
         if not results:
             messagebox.showinfo("搜索結果", "沒有找到相關文檔")
@@ -1182,6 +3846,21 @@ class ClaudeChatUltimate:
         
         text.config(state=tk.DISABLED)
         
+    def change_kb_search_mode(self, event):
+        """更改知識庫搜索模式"""
+        combo = event.widget
+        self.kb.search_mode = combo.get()
+        self.save_config()
+        
+    def rescan_kb(self):
+        """重新掃描知識庫目錄並刷新列表"""
+        def do_rescan():
+            self.kb.load_documents()
+            self.kb.wait_until_ready()
+            self.root.after(0, self.refresh_kb_list)
+        
+        threading.Thread(target=do_rescan, daemon=True).start()
+        
     def refresh_kb_list(self):
         """刷新知識庫列表"""
         self.kb_listbox.delete(0, tk.END)
@@ -1207,6 +3886,10 @@ class ClaudeChatUltimate:
             messagebox.showwarning("警告", "請先設置API Key")
             return
         
+        if self.pending_images:
+            messagebox.showinfo("提示", "圖片還在處理中,請稍候再發送")
+            return
+        
         # 清空輸入框
         self.input_text.delete("1.0", tk.END)
         
@@ -1220,6 +3903,7 @@ class ClaudeChatUltimate:
         # 檢查是否需要搜索知識庫
         if self.kb.documents:
             kb_results = self.kb.search(message)
+            self.update_stats()
             if kb_results:
                 kb_context = "相關知識庫內容:\n\n"
                 for result in kb_results:
@@ -1242,39 +3926,148 @@ class ClaudeChatUltimate:
             'role': 'user',
             'content': content if len(content) > 1 else message
         }
-        self.conversation_history.append(user_message)
+        self._append_history(user_message)
         
-        # 顯示用戶消息
+        # 顯示用戶消息,並記下它的回復在聊天區中的位置
         self.display_message(self.user_name, message, is_user=True)
+        self._mark_reply_position(user_message)
         
         # 清除圖片
         self.uploaded_images.clear()
         for widget in self.image_preview_frame.winfo_children():
             widget.destroy()
         
-        # 在新線程中調用API
-        threading.Thread(target=self.get_response, daemon=True).start()
-        
-    def get_response(self):
-        """獲取AI響應"""
+        # 交給請求引擎,對話請求按發送順序逐條處理
+        self.engine.submit(lambda token: self.get_response(token, user_message),
+                           on_cancel=lambda e: self.cancel_queued_message(user_message),
+                           channel="chat")
+        
+    def stop_generation(self):
+        """停止正在生成和排隊中的對話響應"""
+        self.engine.cancel_channel("chat")
+        
+    def cancel_queued_message(self, user_message):
+        """排隊中的消息在發送前被取消: 補上佔位回復,保持user/assistant交替"""
+        response_text = "(已停止生成)"
+        self._insert_response(user_message, response_text)
+        self.display_reply(user_message, response_text)
+        
+    def get_response(self, token=None, user_message=None):
+        """獲取AI響應(在請求引擎的工作線程中執行)
+        
+        user_message之後排隊的消息不會發送,響應插入在user_message之後,
+        連續發送多條消息時每條都得到自己的回復且歷史順序正確
+        """
+        streaming = self.stream_responses
+        position = self._history_position(user_message)
+        if position is None:
+            # 排隊期間對話已被清空或替換,這條消息不再屬於當前對話
+            return
+        messages = self.conversation_history[:position]
         try:
-            response_text = self.call_claude_api(None)
+            if streaming:
+                # 增量文本通過root.after送回主線程顯示
+                self.root.after(0, self.begin_stream_message, user_message)
+                response_text = self.call_claude_api(
+                    None, on_delta=lambda delta: self.root.after(0, self.append_stream_text, delta),
+                    token=token, messages=messages)
+            else:
+                response_text = self.call_claude_api(None, token=token, messages=messages)
             
             # 添加到對話歷史
-            self.conversation_history.append({
-                'role': 'assistant',
-                'content': response_text
-            })
+            self._insert_response(user_message, response_text)
             
             # 在主線程中更新UI
-            self.root.after(0, lambda: self.display_message(self.ai_name, response_text, is_user=False))
+            if streaming:
+                self.root.after(0, self.finish_stream_message)
+            else:
+                self.root.after(0, self.display_reply, user_message, response_text)
+            self.root.after(0, self.maybe_roll_summary)
+            
+        except RequestCancelled as e:
+            # 保留已生成的部分,並保持user/assistant交替
+            response_text = e.partial_text or "(已停止生成)"
+            self._insert_response(user_message, response_text)
+            if streaming:
+                if not e.partial_text:
+                    self.root.after(0, self.append_stream_text, response_text)
+                self.root.after(0, self.finish_stream_message)
+            else:
+                self.root.after(0, self.display_reply, user_message, response_text)
             
         except Exception as e:
             error_msg = f"API調用失敗: {e}"
+            if streaming:
+                self.root.after(0, self.finish_stream_message)
             self.root.after(0, lambda: messagebox.showerror("錯誤", error_msg))
             
-    def call_claude_api(self, single_message=None, use_cache=True):
-        """調用Claude API"""
+    def _mark_reply_position(self, user_message):
+        """在用戶消息的顯示之後設置標記(向右移動),回復插入在這裡
+        
+        生成過程中繼續發送的消息顯示在末尾,不會插進正在生成的回復,也不會被它刪除
+        """
+        self._reply_marks += 1
+        mark = f"reply_{self._reply_marks}"
+        self.chat_display.mark_set(mark, 'end-1c')
+        self.chat_display.mark_gravity(mark, tk.RIGHT)
+        user_message['_reply_mark'] = mark
+        
+    def _reply_index(self, user_message):
+        """回復的插入位置: 用戶消息之後的標記,沒有時(例如聊天區已刷新)為末尾"""
+        mark = user_message.get('_reply_mark') if user_message else None
+        if mark and mark in self.chat_display.mark_names():
+            return mark
+        return tk.END
+        
+    def _release_reply_index(self, index):
+        if index != tk.END:
+            self.chat_display.mark_unset(index)
+        
+    def _clear_chat_display(self):
+        """清空聊天區,丟棄回復位置標記;正在生成的回復對應的消息已不在當前對話中,不再顯示"""
+        self.chat_display.delete("1.0", tk.END)
+        for mark in self.chat_display.mark_names():
+            if mark.startswith('reply_'):
+                self.chat_display.mark_unset(mark)
+        self._stream_renderer = None
+        
+    def _history_position(self, user_message):
+        """user_message在對話歷史中的下一個位置(未指定時為歷史末尾,已被清空時為None)"""
+        if user_message is None:
+            return len(self.conversation_history)
+        for index, message in enumerate(self.conversation_history):
+            if message is user_message:
+                return index + 1
+        return None
+        
+    def _insert_response(self, user_message, response_text):
+        """把響應插入到對應的用戶消息之後"""
+        position = self._history_position(user_message)
+        if position is not None:
+            message = {
+                'role': 'assistant',
+                'content': response_text
+            }
+            self.conversation_history.insert(position, message)
+            self._persist_message(message, reply_to=user_message.get('_seq') if user_message else None)
+        
+    def _append_history(self, message):
+        """添加消息到對話歷史並寫入會話存儲"""
+        self.conversation_history.append(message)
+        self._persist_message(message)
+        
+    def _persist_message(self, message, reply_to=None):
+        try:
+            message['_seq'] = self.conversation_store.append(message, reply_to)
+        except OSError as e:
+            print(f"保存對話失敗: {e}")
+        
+    def call_claude_api(self, single_message=None, use_cache=True, on_delta=None, token=None,
+                        messages=None):
+        """調用Claude API(提供on_delta時以SSE流式接收,每個增量文本調用一次on_delta)"""
+        if token:
+            token.raise_if_cancelled()
+        
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
@@ -1284,21 +4077,23 @@ class ClaudeChatUltimate:
         if use_cache:
             headers["anthropic-beta"] = "prompt-caching-2024-07-31"
         
+        # 構建System Prompt
+        system_prompt = self.system_text.get("1.0", tk.END).strip()
+        system_content = []
+        
         # 構建消息
         if single_message:
             messages = [{'role': 'user', 'content': single_message}]
         else:
-            messages = self.conversation_history.copy()
-        
-        # 構建System Prompt
-        system_prompt = self.system_text.get("1.0", tk.END).strip()
-        system_content = []
+            if messages is None:
+                messages = self.conversation_history
+            messages = self.context_manager.build(
+                messages, ContextWindowManager.estimate_text(system_prompt))
         
         if system_prompt:
             system_content.append({
                 "type": "text",
-                "text": system_prompt,
-                "cache_control": {"type": "ephemeral"} if use_cache else None
+                "text": system_prompt
             })
         
         # 如果啟用聯網搜索,添加提示
@@ -1308,6 +4103,22 @@ class ClaudeChatUltimate:
                 "text": "\n你有聯網搜索能力,可以搜索實時信息。如果需要最新信息,請告訴用戶你正在搜索。"
             })
         
+        if not single_message and self.context_manager.dropped:
+            # 被裁掉的早期對話用滾動摘要代替;摘要滯後時(未開啟自動摘要、合併失敗或仍在進行)
+            # 水位線之後被裁掉的消息沒有被摘要覆蓋,仍然說明它們未包含
+            dropped = self.context_manager.dropped
+            covered = min(dropped, self.rolling_summarizer.covered(self.conversation_history))
+            omitted_text = ""
+            if covered:
+                omitted_text = f"\n以下是較早對話的摘要(原消息未包含在本次對話中):\n{self.rolling_summarizer.summary}"
+            if dropped > covered:
+                omitted_text += (f"\n(為控制上下文長度,{'摘要之後' if covered else '較早'}的"
+                                 f"{dropped - covered}條消息未包含在本次對話中)")
+            system_content.append({
+                "type": "text",
+                "text": omitted_text
+            })
+        
         data = {
             "model": "anthropic/claude-sonnet-4-20250514",
             "max_tokens": 4096,
@@ -1317,66 +4128,195 @@ class ClaudeChatUltimate:
         if system_content:
             data["system"] = system_content
         
+        # 在穩定前綴上放置緩存斷點
+        cache_plan = None
+        if use_cache:
+            cache_plan = self.cache_planner.plan(system_content, messages)
+        
+        # 本地響應緩存: 相同請求直接返回,不產生token費用
+        cache_key = None
+        if self.response_cache_enabled:
+            cache_key = ResponseCache.make_key(data)
+            cached_text = self.response_cache.get(cache_key)
+            if cached_text is not None:
+                if on_delta:
+                    on_delta(cached_text)
+                self.root.after(0, self.update_stats)
+                return cached_text
+        
+        if on_delta:
+            data["stream"] = True
+            data["stream_options"] = {"include_usage": True}
+        
+        # 圖片引用在發送前才展開成base64,緩存規劃和響應緩存都只看引用
+        if any(not isinstance(message['content'], str) for message in messages):
+            data = {**data, "messages": [self.image_store.expand_message(message) for message in messages]}
+        
         # 發送請求
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
+        request_started = time.perf_counter()
+        response = self.scheduler.post(
+            "/chat/completions",
             headers=headers,
-            json=data
+            json_data=data,
+            stream=bool(on_delta),
+            token=token
         )
         
         if response.status_code != 200:
             raise Exception(f"API返回錯誤: {response.status_code} - {response.text}")
         
-        result = response.json()
-        
-        # 提取響應文本
-        response_text = result['choices'][0]['message']['content']
-        
-        # 更新統計(如果有usage信息)
-        if 'usage' in result:
-            usage = result['usage']
-            input_tokens = usage.get('prompt_tokens', 0)
-            output_tokens = usage.get('completion_tokens', 0)
-            cache_creation = usage.get('cache_creation_input_tokens', 0)
-            cache_read = usage.get('cache_read_input_tokens', 0)
+        if on_delta:
+            response_text = self._read_stream(response, on_delta, request_started, token, cache_plan)
+        else:
+            result = response.json()
+            
+            # 提取響應文本
+            response_text = result['choices'][0]['message']['content']
             
-            self.total_input_tokens += input_tokens
-            self.total_output_tokens += output_tokens
-            self.total_cache_creation_tokens += cache_creation
-            self.total_cache_read_tokens += cache_read
+            # 更新統計(如果有usage信息)
+            if 'usage' in result:
+                self._record_usage(result['usage'], cache_plan)
             
-            # 更新統計顯示
-            self.root.after(0, self.update_stats)
+            # 非流式響應無法中途打斷,等待期間被取消時丟棄結果(用量已計入統計)
+            if token:
+                token.raise_if_cancelled()
         
+        if cache_key:
+            self.response_cache.put(cache_key, response_text)
         return response_text
         
-    def display_message(self, sender, message, is_user=False):
-        """顯示消息"""
+    def _read_stream(self, response, on_delta, request_started, token=None, cache_plan=None):
+        """逐行解析SSE事件,把增量文本交給on_delta,流結束時記錄usage"""
+        parts = []
+        usage = None
+        try:
+            # chunk_size=None: 數據到達多少就處理多少,不等緩衝區填滿
+            for line in response.iter_lines(chunk_size=None):
+                if token:
+                    token.raise_if_cancelled(''.join(parts))
+                # 空行分隔事件,冒號開頭的是保活注釋
+                if not line.startswith(b'data:'):
+                    continue
+                payload = line[5:].strip()
+                if payload == b'[DONE]':
+                    # 不提前break: 讀完整個響應,連接才能放回連接池復用
+                    continue
+                
+                event = json.loads(payload)
+                if 'error' in event:
+                    raise Exception(f"API返回錯誤: {event['error']}")
+                if event.get('usage'):
+                    usage = event['usage']
+                for choice in event.get('choices', []):
+                    delta = (choice.get('delta') or {}).get('content')
+                    if delta:
+                        if not parts:
+                            self.last_ttft = time.perf_counter() - request_started
+                        parts.append(delta)
+                        on_delta(delta)
+        except RequestCancelled:
+            raise
+        except Exception:
+            # 取消時響應被另一線程關閉,讀取會以各種異常結束
+            if token and token.cancelled:
+                raise RequestCancelled(''.join(parts)) from None
+            raise
+        finally:
+            response.close()
+        
+        if token:
+            token.raise_if_cancelled(''.join(parts))
+        
+        if usage:
+            self._record_usage(usage, cache_plan)
+        return ''.join(parts)
+        
+    def _record_usage(self, usage, cache_plan=None):
+        """累計token用量並刷新統計顯示"""
+        if cache_plan is not None:
+            self.cache_planner.observe(cache_plan, usage)
+        self.total_input_tokens += usage.get('prompt_tokens', 0)
+        self.total_output_tokens += usage.get('completion_tokens', 0)
+        self.total_cache_creation_tokens += usage.get('cache_creation_input_tokens', 0)
+        self.total_cache_read_tokens += usage.get('cache_read_input_tokens', 0)
+        
+        # 更新統計顯示
+        self.root.after(0, self.update_stats)
+        
+    def begin_stream_message(self, user_message=None):
+        """開始顯示一條流式響應(插入在對應的用戶消息之後)"""
+        index = self._reply_index(user_message)
+        self.chat_display.config(state=tk.NORMAL)
+        self.chat_display.insert(index, f"\n{self.ai_name}:\n", 'ai')
+        self._stream_renderer = StreamingMarkdownRenderer(self.chat_display, index=index)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(index)
+        
+    def append_stream_text(self, delta):
+        """追加流式響應的增量文本,邊接收邊按Markdown渲染"""
+        if self._stream_renderer is None:
+            return
+        self.chat_display.config(state=tk.NORMAL)
+        self._stream_renderer.feed(delta)
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(self._stream_renderer.index)
+        
+    def finish_stream_message(self):
+        """流式響應結束,渲染最後一行"""
+        if self._stream_renderer is None:
+            return
+        index = self._stream_renderer.index
+        self.chat_display.config(state=tk.NORMAL)
+        self._stream_renderer.finish()
+        self.chat_display.insert(index, "\n")
+        self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(index)
+        self._release_reply_index(index)
+        self._stream_renderer = None
+        
+    def display_reply(self, user_message, response_text):
+        """在對應的用戶消息之後顯示非流式響應"""
+        if user_message is not None and self._history_position(user_message) is None:
+            return  # 對話已清空或切換
+        index = self._reply_index(user_message)
+        self.display_message(self.ai_name, response_text, is_user=False, index=index)
+        self._release_reply_index(index)
+        
+    def display_message(self, sender, message, is_user=False, index=tk.END):
+        """顯示消息(index為插入位置,默認為末尾)"""
         self.chat_display.config(state=tk.NORMAL)
+        # 回復標記可能正好在末尾,追加到末尾時暫時讓它們留在原處,不跟著移到這條消息之後
+        pinned = [mark for mark in self.chat_display.mark_names()
+                  if mark.startswith('reply_')] if index == tk.END else []
+        for mark in pinned:
+            self.chat_display.mark_gravity(mark, tk.LEFT)
         
         # 添加發送者標籤
         tag = 'user' if is_user else 'ai'
-        self.chat_display.insert(tk.END, f"\n{sender}:\n", tag)
+        self.chat_display.insert(index, f"\n{sender}:\n", tag)
         
         # 渲染消息內容
         if is_user:
-            self.chat_display.insert(tk.END, message + "\n", tag)
+            self.chat_display.insert(index, message + "\n", tag)
         else:
             # 使用Markdown渲染器
             MarkdownRenderer.render_to_text_widget(
                 self.chat_display, 
                 message,
-                None
+                None,
+                index
             )
-            self.chat_display.insert(tk.END, "\n")
+            self.chat_display.insert(index, "\n")
         
+        for mark in pinned:
+            self.chat_display.mark_gravity(mark, tk.RIGHT)
         self.chat_display.config(state=tk.DISABLED)
-        self.chat_display.see(tk.END)
+        self.chat_display.see(index)
         
     def refresh_chat_display(self):
         """刷新整個對話顯示"""
         self.chat_display.config(state=tk.NORMAL)
-        self.chat_display.delete("1.0", tk.END)
+        self._clear_chat_display()
         
         for msg in self.conversation_history:
             role = msg['role']
@@ -1402,12 +4342,35 @@ class ClaudeChatUltimate:
         saved = cost_without_cache - total_cost
         saved_percent = (saved / cost_without_cache * 100) if cost_without_cache > 0 else 0
         
-        stats_text = (
-            f"💰 總成本: ${total_cost:.4f} | "
-            f"💸 節省: ${saved:.4f} ({saved_percent:.1f}%) | "
+        stats_parts = [
+            f"💰 總成本: ${total_cost:.4f}",
+            f"💸 節省: ${saved:.4f} ({saved_percent:.1f}%)",
             f"📊 Input: {self.total_input_tokens} | Output: {self.total_output_tokens} | "
-            f"Cache: {self.total_cache_read_tokens}"
-        )
+            f"Cache: {self.total_cache_read_tokens}",
+            f"🔍 知識庫緩存: 命中 {self.kb.cache_hits} / 未命中 {self.kb.cache_misses}"
+        ]
+        if self.last_ttft is not None:
+            stats_parts.append(f"⏱ 首字: {self.last_ttft:.2f}s")
+        if self.api_client.last_server_time is not None:
+            stats_parts.append(
+                f"🔌 連接: {self.api_client.last_connect_time * 1000:.0f}ms / "
+                f"服務器: {self.api_client.last_server_time * 1000:.0f}ms"
+            )
+        if self.response_cache_enabled:
+            stats_parts.append(f"💾 響應緩存: 命中 {self.response_cache.hits}")
+        if self.image_bytes_saved:
+            stats_parts.append(f"🖼 圖片壓縮節省: {self.image_bytes_saved / 1024 / 1024:.1f}MB")
+        if self.cache_planner.hit_rate is not None:
+            stats_parts.append(f"🎯 緩存命中率: {self.cache_planner.hit_rate * 100:.0f}%")
+        if self.context_manager.last_tokens:
+            context_text = f"📐 上下文: ~{self.context_manager.last_tokens}"
+            if self.context_manager.dropped:
+                context_text += f" (省略{self.context_manager.dropped}條)"
+            stats_parts.append(context_text)
+        queued = self.engine.queued + self.scheduler.waiting
+        if queued or self.scheduler.retries:
+            stats_parts.append(f"⏳ 排隊: {queued} | 🔁 重試: {self.scheduler.retries}")
+        stats_text = " | ".join(stats_parts)
         
         self.stats_label.config(text=stats_text)
         
@@ -1433,14 +4396,87 @@ class ClaudeChatUltimate:
     def clear_conversation(self):
         """清空對話"""
         if messagebox.askyesno("確認", "確定要清空對話嗎?"):
+            self.engine.cancel_channel("chat")
+            self.engine.cancel_channel("summary")
             self.conversation_history.clear()
+            self.conversation_store.new_session()
+            self.context_manager.reset()
+            self.rolling_summarizer.reset()
             self.chat_display.config(state=tk.NORMAL)
-            self.chat_display.delete("1.0", tk.END)
+            self._clear_chat_display()
             self.chat_display.config(state=tk.DISABLED)
             messagebox.showinfo("完成", "對話已清空")
             
+    def show_sessions(self):
+        """顯示已保存的會話,可以恢復或刪除"""
+        sessions = self.conversation_store.list_sessions()
+        if not sessions:
+            messagebox.showinfo("提示", "還沒有保存的會話")
+            return
+        
+        window = tk.Toplevel(self.root)
+        window.title("歷史會話")
+        window.geometry("520x360")
+        
+        listbox = tk.Listbox(window)
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        for session in sessions:
+            listbox.insert(tk.END, f"{session['updated']:%Y-%m-%d %H:%M}  "
+                                   f"({session['count']}條)  {session['title']}")
+        
+        def selected():
+            selection = listbox.curselection()
+            return sessions[selection[0]] if selection else None
+        
+        def resume():
+            session = selected()
+            if session:
+                window.destroy()
+                self.resume_session(session['id'])
+        
+        def delete():
+            session = selected()
+            if session and messagebox.askyesno("確認", "確定要刪除這個會話嗎?", parent=window):
+                self.conversation_store.delete(session['id'])
+                index = sessions.index(session)
+                sessions.pop(index)
+                listbox.delete(index)
+        
+        listbox.bind('<Double-Button-1>', lambda e: resume())
+        button_frame = ttk.Frame(window)
+        button_frame.pack(fill=tk.X, pady=5)
+        ttk.Button(button_frame, text="▶ 恢復", command=resume).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="🗑 刪除", command=delete).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="❌ 關閉", command=window.destroy).pack(side=tk.RIGHT, padx=5)
+        
+    def resume_session(self, session_id):
+        """恢復會話,只加載最近的消息"""
+        self.engine.cancel_channel("chat")
+        self.engine.cancel_channel("summary")
+        try:
+            messages, skipped = self.conversation_store.load(session_id)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("錯誤", f"加載會話失敗: {e}")
+            return
+        
+        self.conversation_history = messages
+        self.context_manager.reset()
+        self.rolling_summarizer.reset()
+        self.refresh_chat_display()
+        if skipped:
+            self.chat_display.config(state=tk.NORMAL)
+            self.chat_display.insert("1.0", f"(更早的{skipped}條消息未加載)\n")
+            self.chat_display.config(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+        
     def save_config(self):
         """保存配置"""
+        try:
+            self.context_budget = max(1000, int(self.context_budget_var.get()))
+        except ValueError:
+            self.context_budget_var.set(str(self.context_budget))
+        self.context_manager.budget = self.context_budget
+        
         config = {
             'api_key': self.api_key_entry.get(),
             'system_prompt': self.system_text.get("1.0", tk.END).strip(),
@@ -1449,7 +4485,16 @@ class ClaudeChatUltimate:
             'user_name': self.user_name,
             'ai_name': self.ai_name,
             'background_opacity': self.background_opacity,
-            'background_image_path': self.background_image_path if hasattr(self, 'background_image_path') else None
+            'background_image_path': self.background_image_path if hasattr(self, 'background_image_path') else None,
+            'kb_search_mode': self.kb.search_mode,
+            'kb_lazy_loading': self.kb_lazy_loading,
+            'kb_watch_enabled': self.kb_watch_enabled,
+            'stream_responses': self.stream_responses,
+            'auto_summary': self.auto_summary,
+            'response_cache_enabled': self.response_cache_enabled,
+            'http_warm_up': self.http_warm_up,
+            'api_rate_limit': self.api_rate_limit,
+            'context_budget': self.context_budget
         }
         
         with open(self.config_file, 'w', encoding='utf-8') as f:
@@ -1475,6 +4520,17 @@ class ClaudeChatUltimate:
                 self.ai_name = config.get('ai_name', 'Claude')
                 self.background_opacity = config.get('background_opacity', 0.3)
                 self.background_image_path = config.get('background_image_path', None)
+                kb_search_mode = config.get('kb_search_mode', 'keyword')
+                if kb_search_mode in KnowledgeBase.SEARCH_MODES:
+                    self.kb_search_mode = kb_search_mode
+                self.kb_lazy_loading = config.get('kb_lazy_loading', True)
+                self.kb_watch_enabled = config.get('kb_watch_enabled', True)
+                self.stream_responses = config.get('stream_responses', True)
+                self.auto_summary = config.get('auto_summary', True)
+                self.response_cache_enabled = config.get('response_cache_enabled', False)
+                self.http_warm_up = config.get('http_warm_up', True)
+                self.api_rate_limit = config.get('api_rate_limit', 60)
+                self.context_budget = config.get('context_budget', ContextWindowManager.DEFAULT_BUDGET)
             except Exception as e:
                 print(f"加載配置失敗: {e}")
 